@@ -1,6 +1,31 @@
-__version__ = '1.0'
+__version__ = '1.4'
 
 from .symbol import *
 from .update import *
 from .wire import *
-from .client import *
+from .ratelimit import *
+from .manager import *
+from . import client as _client
+
+# The emote and history stores are left to __getattr__, as a star
+# import of the client would load them right away.
+_lazy = ('AsyncClient', 'PendingSend', 'Emote', 'EmoteStore', 'HistoryStore')
+globals().update((name, getattr(_client, name)) for name in _client.__all__ if name not in _lazy)
+# Emote is the client's emote rather than the update class, as before.
+del Emote
+
+__all__ = sorted([name for name in globals() if not name.startswith('_')] + list(_lazy))
+
+def __getattr__(name):
+    # The asyncio client, the emote and history stores, and the
+    # extension update classes are only loaded once they are first
+    # used, to keep the import cheap.
+    if name in ('AsyncClient', 'PendingSend'):
+        from . import aio
+        return getattr(aio, name)
+    if name in ('Emote', 'EmoteStore', 'HistoryStore'):
+        return getattr(_client, name)
+    from . import update
+    if name in update.lazy_names:
+        return getattr(update, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -37,9 +37,8 @@ def loop(client):
         if len(line) != 0:
             handle_input(client, line)
 
-def on_misc(client, u):
-    if isinstance(u, Failure):
-        print('ERROR: {0}'.format(u.text))
+def on_failure(client, u):
+    print('ERROR: {0}'.format(u.text))
 
 def on_message(client, u):
     print('[{0}] <{1}> {2}'.format(u.channel, u['from'], u.text))
@@ -63,7 +62,7 @@ def main():
 def main_(username=None, host="chat.tymoon.eu", port=1111):
     client = MyClient(username)
     client.channel = None
-    client.add_handler(Update, on_misc)
+    client.add_handler(Failure, on_failure)
     client.add_handler(Message, on_message)
     client.add_handler(Join, on_join)
     client.add_handler(Leave, on_leave)
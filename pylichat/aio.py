@@ -0,0 +1,313 @@
+from . import update
+from . import wire
+from .client import Client, ConnectionFailed, ConnectionLost, SearchPages, decode_frames, split_frames
+from .payload import write_streamed
+import asyncio
+import collections
+import ssl
+import time
+
+class PendingSend:
+    """Handle for an update that was queued on an AsyncClient.
+
+    Awaiting it waits until the transport's write buffer has
+    drained, and then returns the ID of the sent update. The ID
+    is also available directly through the id field.
+    """
+    __slots__ = 'client', 'id'
+
+    def __init__(self, client, id):
+        self.client = client
+        self.id = id
+
+    def __await__(self):
+        writer = self.client.socket
+        if writer is not None:
+            self.client.flush()
+            yield from writer.drain().__await__()
+        return self.id
+
+class AsyncClient(Client):
+    """A Lichat client running on asyncio streams.
+
+    The client keeps the same state, handlers, and callback
+    semantics as Client. Handlers are still plain functions and
+    are invoked synchronously by handle.
+
+    The differences are that connect, disconnect, recv, and loop
+    are coroutines, and that send and send_callback return a
+    PendingSend that can be awaited to wait for the data to be
+    flushed out. In buffered mode, flush hands the queued
+    updates to the transport in one write. send_file is a
+    coroutine as well, which waits for the transport to drain
+    between chunks. send_request returns an asyncio future,
+    which is resolved while another task handles updates, or
+    by awaiting wait. Updates can also be received by iterating over
+    the client with async for:
+
+        async for update in client:
+            client.handle(update)
+
+    The socket field holds the asyncio StreamWriter of the
+    connection.
+    """
+    __slots__ = ('reader', 'pending', 'streaming')
+
+    def __init__(self, username=None, password=None):
+        super().__init__(username, password)
+        self.socket = None
+        self.reader = None
+        self.pending = collections.deque()
+        self.streaming = None
+
+    async def connect(self, host, port=None, timeout=10.0, username=None, password=None, ssl=False, ssl_options={}):
+        """Attempts to establish a connection to the given server.
+
+        See Client.connect
+        """
+        if username != None: self.username = username
+        if password != None: self.password = password
+        if self.password == '': self.password = None
+        if self.connected:
+            raise ValueError("Already connected!")
+        await asyncio.wait_for(self.connect_raw(host=host, port=port, use_ssl=ssl, ssl_options=ssl_options), timeout)
+        await self.send(update.Connect, password=self.password, version=update.version, extensions=list(update.extensions))
+        updates = await self.recv(timeout)
+        if updates:
+            if type(updates[0]) is not update.Connect:
+                self.socket.close()
+                self.socket = None
+                raise ConnectionFailed(update=updates[0])
+            for instance in updates:
+                self.handle(instance)
+        else:
+            self.socket.close()
+            self.socket = None
+            raise ConnectionFailed(message="Timeout")
+
+    async def disconnect(self, timeout=3):
+        """Initiates a disconnect handshake if the client is connected."""
+        if self.connected:
+            writer = self.socket
+            await self.send(update.Disconnect)
+            for instance in await self.recv(timeout):
+                self.handle(instance)
+            if self.socket != None:
+                self.socket.close()
+            self.socket = None
+            self.connected = False
+            try:
+                await writer.wait_closed()
+            except (OSError, ConnectionError):
+                pass
+
+    def disconnect_raw(self):
+        super().disconnect_raw()
+        self.reader = None
+        self.pending.clear()
+
+    def send(self, type, **args):
+        """Queues a new update for the given type and set of arguments.
+
+        Returns a PendingSend that may be awaited.
+
+        See Client.send
+        """
+        return PendingSend(self, super().send(type, **args))
+
+    def send_callback(self, callback, type, **args):
+        """Queues a new update with a callback for its response.
+
+        Returns a PendingSend that may be awaited.
+
+        See Client.send_callback
+        """
+        return PendingSend(self, super().send_callback(callback, type, **args))
+
+    async def send_file(self, channel, path, content_type=None, filename=None, **args):
+        """Sends the file at the path to the channel as a data update.
+
+        Waits for the transport to drain after every chunk, so
+        that the file is never held in memory as a whole. Other
+        updates sent in the meantime are held back until the file
+        has been sent. Returns the ID of the sent update.
+
+        See Client.send_file
+        """
+        if self.socket is None:
+            raise ConnectionLost("not connected")
+        instance = self.make_file_instance(channel, path, content_type, filename, **args)
+        self.flush()
+        if self.streaming is None:
+            self.streaming = asyncio.Lock()
+        async with self.streaming:
+            while self.limiter is not None and not self.limiter.admit(instance):
+                delay = self.release_queued()
+                if delay is None:
+                    delay = self.limiter.delay(None, time.monotonic())
+                await asyncio.sleep(max(delay, 0.001))
+            writer = self.socket
+            buffer = bytearray()
+            size = 0
+            written = False
+            try:
+                for size in write_streamed(instance, buffer):
+                    if self.flush_threshold <= len(buffer):
+                        writer.write(bytes(buffer))
+                        written = True
+                        del buffer[:]
+                        await writer.drain()
+            except ConnectionLost:
+                raise
+            except BaseException as e:
+                if not written:
+                    raise
+                # Part of the frame is already out, the stream cannot recover.
+                self.disconnect_raw()
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                raise ConnectionLost("failed to send payload")
+            writer.write(bytes(buffer))
+        if self.metrics is not None:
+            self.metrics.sent(instance, size)
+        self.track(instance, size)
+        await self.drain()
+        return instance.id
+
+    def make_future(self):
+        return asyncio.get_running_loop().create_future()
+
+    async def wait(self, future, timeout=None):
+        """Receive and handle updates until the future is done, and return its result.
+
+        See Client.wait
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not future.done():
+            remaining = 1.0 if deadline is None else deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("No response within the timeout.")
+            if self.socket is None:
+                raise ConnectionLost("not connected")
+            for instance in await self.recv(min(remaining, 1.0)):
+                self.handle(instance)
+            self.expire()
+        return future.result()
+
+    async def search(self, channel, query, prefetch=2, timeout=None):
+        """Search the history of the channel and return an async iterator over the results.
+
+        See Client.search
+        """
+        pages = SearchPages(self, channel, query, prefetch=prefetch, timeout=timeout)
+        try:
+            while not pages.done():
+                (offset, future) = pages.head()
+                for result in pages.take(offset, await self.wait(future)):
+                    yield result
+        finally:
+            pages.close()
+
+    async def recv(self, timeout=None):
+        """Receive updates.
+
+        Returns a list of update instances that were received.
+        If timeout is None, waits until at least one update
+        has arrived.
+
+        See Client.recv
+        """
+        return self.make_updates(await self.recv_raw(timeout))
+
+    async def loop(self):
+        """Perform a basic connection loop of just receiving and handling updates."""
+        async for instance in self:
+            self.handle(instance)
+            if not self.connected:
+                break
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while not self.pending:
+            if self.reader is None or self.reader.at_eof():
+                raise StopAsyncIteration
+            self.pending.extend(await self.recv())
+        return self.pending.popleft()
+
+    async def connect_raw(self, host, port=None, use_ssl=False, ssl_options={}):
+        context = None
+        if use_ssl:
+            context = ssl.create_default_context(**ssl_options)
+        if port == None:
+            if use_ssl: port = 1112
+            else: port = 1111
+        # Let the stream buffer enough to fill the receive window.
+        limit = max(2**16, self.batch_threshold, self.window)
+        (self.reader, self.socket) = await asyncio.open_connection(host, port, ssl=context, limit=limit)
+
+    def flush(self, block=False):
+        """Hand the queued updates to the transport.
+
+        The transport sends them out in the background, await
+        drain to wait for that.
+        """
+        if self.socket is None or self.socket.is_closing():
+            self.disconnect_raw()
+            raise ConnectionLost("send error")
+        if self.pending_output() and not (self.streaming is not None and self.streaming.locked()):
+            self.socket.write(bytes(self.outgoing[self.outgoing_start:]))
+            del self.outgoing[:]
+            self.outgoing_start = 0
+        return True
+
+    async def decode(self, data):
+        """Parse received bytes like feed, but await the decoder_pool instead of blocking."""
+        if not self.is_batch(data):
+            return self.parse(data)
+        data = bytes(data)
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        results = await asyncio.gather(*[loop.run_in_executor(self.decoder_pool, decode_frames, piece)
+                                         for piece in split_frames(data, self.batch_size)])
+        return self.collect(results, len(data), start)
+
+    async def drain(self):
+        """Flush the queued updates and wait until the transport has sent them."""
+        self.flush()
+        await self.socket.drain()
+
+    async def recv_raw(self, timeout=None):
+        values = []
+        errored = False
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            while not values and not errored:
+                remaining = None if deadline is None else max(0, deadline - time.monotonic())
+                self.expire()
+                delay = self.release_queued()
+                if delay is not None and (remaining is None or delay < remaining):
+                    remaining = delay
+                self.flush()
+                try:
+                    self.make_room()
+                    space = len(self.incoming) - self.incoming_end
+                    chunk = await asyncio.wait_for(self.reader.read(space), remaining)
+                except asyncio.TimeoutError:
+                    if deadline is not None and deadline <= time.monotonic():
+                        break
+                    continue
+                if len(chunk) == 0:
+                    errored = True
+                    break
+                end = self.incoming_end + len(chunk)
+                self.incoming[self.incoming_end:end] = chunk
+                self.incoming_end = end
+                values += await self.decode(self.take_frames())
+        except asyncio.CancelledError:
+            raise
+        except:
+            errored = True
+        if errored: values += [wire.from_string(f"(disconnect :from \"{self.servername}\" :id 0)")[0]]
+        return values
@@ -0,0 +1,192 @@
+from . import __version__
+from . import update
+from . import wire
+from .client import Client
+import argparse
+import base64
+import json
+import platform
+import random
+import socket
+import time
+import tracemalloc
+
+benchmarks = {}
+
+def benchmark(name):
+    """Register the decorated function as the benchmark with the given name.
+
+    A benchmark function returns a dictionary of measurements.
+    """
+    def register(fun):
+        benchmarks[name] = fun
+        return fun
+    return register
+
+def measure(fun, number=10000, repeat=5):
+    """Returns the best time per call to fun in microseconds."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fun()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best / number * 1000000
+
+def measure_memory(fun, number=10000):
+    """Returns the bytes allocated per object returned by fun and kept alive."""
+    fun()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        kept = [fun() for _ in range(number)]
+        after = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    del kept
+    return size / number
+
+def make_message():
+    return update.make_instance(update.Message, id=1, clock=3900000000, channel='lobby', text='Hello there!', **{'from': 'tester'})
+
+def make_corpus():
+    """Returns a dictionary of named values to read and write.
+
+    The corpus is generated from a fixed seed, so that it is the
+    same on every run.
+    """
+    rand = random.Random(0)
+    deep = []
+    for _ in range(64):
+        deep = [deep, rand.randint(0, 1000)]
+    payload = base64.b64encode(bytes(rand.getrandbits(8) for _ in range(256*1024))).decode('ascii')
+    return {
+        'message': make_message().to_list(),
+        'escaped-message': update.make_instance(update.Message, id=2, clock=3900000000, channel='lobby', text='"Quoted" \\ text with ünïcödé ✓'*4, **{'from': 'tester'}).to_list(),
+        'ping': update.make_instance(update.Ping, id=3, clock=3900000000, **{'from': 'tester'}).to_list(),
+        'users': update.make_instance(update.Users, id=4, clock=3900000000, channel='lobby', users=[f"user{i}" for i in range(500)], **{'from': 'tester'}).to_list(),
+        'deep-list': deep,
+        'wide-list': [[rand.randint(0, 1000000), f"item{i}", update.kw('key')] for i in range(200)],
+        'floats': [0.0, 0.5, 123.456, 3.141592653589793, 0.0025, 1e20, 1e-05, 1.5e-07, float(2**53)],
+        'data-256k': update.make_instance(update.Data, id=5, clock=3900000000, channel='lobby', filename='blob.bin', payload=payload, **{'from': 'tester', 'content-type': 'application/octet-stream'}).to_list()
+    }
+
+def scaled(size, budget=2000000):
+    # Number of repetitions so that every case processes about the same amount of text.
+    return max(3, min(10000, budget // max(1, size)))
+
+@benchmark('wire-read')
+def _():
+    results = {}
+    for (name, value) in make_corpus().items():
+        string = wire.to_string(value)
+        results[name+'_us'] = measure(lambda: wire.from_string(string), number=scaled(len(string)))
+    return results
+
+@benchmark('wire-write')
+def _():
+    results = {}
+    for (name, value) in make_corpus().items():
+        size = len(wire.to_string(value))
+        results[name+'_us'] = measure(lambda: wire.to_string(value), number=scaled(size))
+    return results
+
+@benchmark('wire-parser')
+def _():
+    results = {}
+    for (name, value) in make_corpus().items():
+        data = wire.to_string(value).encode('utf-8') + b'\0'
+        parser = wire.Parser()
+        results[name+'_us'] = measure(lambda: parser.feed(data), number=scaled(len(data)))
+    return results
+
+@benchmark('update-instances')
+def _():
+    message = make_message()
+    plist = message.to_list()
+    return {
+        'construct_us': measure(make_message),
+        'from_plist_us': measure(lambda: update.make_instance_plist(plist[0], plist[1:])),
+        'to_list_us': measure(message.to_list),
+        'bytes_per_instance': measure_memory(make_message)
+    }
+
+@benchmark('client-dispatch')
+def _():
+    client = Client('tester')
+    classes = [update.Update, update.ChannelUpdate, update.TextUpdate, update.Message,
+               update.Join, update.Leave, update.Ping, update.Pong, update.Failure, update.UpdateFailure]
+    for i in range(100):
+        client.add_handler(classes[i % len(classes)], lambda client, instance: None)
+    message = make_message()
+    ping = update.make_instance(update.Ping, id=2, clock=3900000000, **{'from': 'server'})
+    def handle():
+        client.handle(message)
+    return {
+        'handlers': sum(len(handlers) for handlers in client.handlers.values()),
+        'handle_message_us': measure(handle),
+        'find_handlers_us': measure(lambda: client.find_handlers(ping.__class__))
+    }
+
+@benchmark('recv-framing')
+def _():
+    (left, right) = socket.socketpair()
+    try:
+        client = Client('tester')
+        client.socket = left
+        left.setblocking(0)
+        frames = 100
+        batch = b''.join(wire.to_string(make_message().to_list()).encode('utf-8') + b'\0' for _ in range(frames))
+        def receive():
+            right.sendall(batch)
+            count = 0
+            while count < frames:
+                count = count + len(client.recv_raw(1.0))
+        per_batch = measure(receive, number=100)
+        return {
+            'frames_per_batch': frames,
+            'bytes_per_batch': len(batch),
+            'frame_us': per_batch / frames,
+            'megabytes_per_second': len(batch) / per_batch
+        }
+    finally:
+        left.close()
+        right.close()
+
+def package_version():
+    """Returns the installed version of pylichat, or __version__ if it is not installed."""
+    try:
+        import importlib.metadata
+        return importlib.metadata.version('pylichat')
+    except Exception:
+        return __version__
+
+def run(names=None):
+    """Run the named benchmarks, or all of them, and return the results."""
+    results = {}
+    for name in (names or benchmarks):
+        results[name] = benchmarks[name]()
+    return {
+        'pylichat': package_version(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'results': results
+    }
+
+def main(args=None):
+    parser = argparse.ArgumentParser(prog='python -m pylichat.bench', description='Run the pylichat benchmarks.')
+    parser.add_argument('names', nargs='*', help='Benchmarks to run, all by default: '+', '.join(benchmarks))
+    parser.add_argument('-o', '--output', help='File to write the JSON results to instead of stdout.')
+    args = parser.parse_args(args)
+    results = json.dumps(run(args.names), indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(results)
+    else:
+        print(results)
+
+if __name__ == '__main__':
+    main()
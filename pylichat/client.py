@@ -1,20 +1,27 @@
 from . import symbol
 from . import update
 from . import wire
+from .index import MessageIndex
+from .metrics import Metrics
+from .payload import PayloadFile, PayloadSink, write_streamed, is_streamed
+from .ratelimit import RateLimiter
 from .toolkit import *
-from pathlib import Path
 import time
 import select
 import socket
 import ssl
 import base64
-import mimetypes
+import collections
+import copy
+import heapq
 import os
-import errno
 import logging
+import mimetypes
 import random
+import threading
 
 logger = logging.getLogger(__name__)
+user_registry = UserRegistry()
 
 class ConnectionFailed(Exception):
     """Exception thrown when the connection attempt to the server fails for some reason.
@@ -37,26 +44,190 @@ class ConnectionLost(Exception):
     def __init__(self, message='Connection lost.'):
         super().__init__(message)
 
+class RequestFailed(Exception):
+    """Exception thrown when the server responds to a request with a failure.
+
+    Holds an update field with the Failure instance the server sent.
+    """
+    __slots__ = 'update'
+
+    def __init__(self, update, message='Request failed.'):
+        self.update = update
+        if hasattr(update, 'text') and update.text:
+            message = update.text
+        super().__init__(message)
+
 class SwallowUpdate(BaseException):
     """Stop propagation of this update through further handlers."""
     pass
 
+class PendingRequest:
+    """Callback that resolves a future with the response to a sent update.
+
+    If timeout is set, the request expires that many seconds after
+    the update was sent, instead of after in_flight_timeout.
+
+    See Client.send_request
+    """
+    __slots__ = 'future', 'timeout'
+
+    def __init__(self, future, timeout=None):
+        self.future = future
+        self.timeout = timeout
+
+    def __call__(self, client, sent, response):
+        if not self.future.done():
+            self.future.set_result(response)
+
+    def fail(self, exception):
+        if not self.future.done():
+            self.future.set_exception(exception)
+
+class PendingPage(PendingRequest):
+    """Callback that collects the results of a page of a search.
+
+    The server may split a page over several Search updates with
+    the same ID, so the callback stays registered until its
+    SearchPages knows the page to be complete. The future is then
+    resolved with the list of results, or with the failure.
+
+    See SearchPages
+    """
+    __slots__ = 'pages', 'results', 'id'
+
+    def __init__(self, future, pages):
+        super().__init__(future)
+        self.pages = pages
+        self.results = []
+        self.id = None
+
+    def __call__(self, client, sent, response):
+        self.id = sent.id
+        if self.future.done():
+            return
+        self.pages.replied(self)
+        if isinstance(response, update.Failure):
+            self.future.set_result(response)
+            return
+        self.results += response.results or []
+        client.callbacks[sent.id] = (self, sent)
+        self.pages.check(self)
+
+    def finish(self, client):
+        if self.id is not None:
+            client.callbacks.pop(self.id, None)
+        if not self.future.done():
+            self.future.set_result(self.results)
+
+class SearchPages:
+    """The pages of a search in a channel's history, requested ahead of time.
+
+    Keeps up to prefetch Search requests in flight, each for the
+    next page by offset, and always at least one past the page
+    being read. As the server answers in order, a page is known
+    to be complete once a later page is answered, or once it
+    holds as many results as a complete page did before.
+
+    Pages are assumed to hold 50 results, the least the server
+    may send, until a larger page shows the actual size, so
+    overlapping results are skipped. The search ends with the
+    first page of fewer than 50 results.
+
+    See Client.search
+    """
+    __slots__ = 'client', 'channel', 'query', 'prefetch', 'timeout', 'pending', 'next', 'position', 'step', 'known', 'end'
+
+    def __init__(self, client, channel, query, prefetch=2, timeout=None):
+        self.client = client
+        self.channel = channel
+        self.query = query
+        self.prefetch = max(2, prefetch)
+        self.timeout = timeout
+        self.pending = collections.deque()
+        self.next = 0
+        self.position = 0
+        self.step = 50
+        self.known = False
+        self.end = None
+
+    def done(self):
+        return self.end is not None and self.end <= self.position
+
+    def head(self):
+        """Returns the offset and future of the next page, requesting more pages as needed."""
+        while len(self.pending) < self.prefetch and (self.end is None or self.next < self.end):
+            page = PendingPage(self.client.make_future(), self)
+            self.client.send_pending(page, update.Search, timeout=self.timeout,
+                                     channel=self.channel, query=self.query, offset=self.next)
+            self.pending.append((self.next, page))
+            self.next = self.next + self.step
+        (offset, page) = self.pending[0]
+        return (offset, page.future)
+
+    def replied(self, page):
+        # Replies come in order, so every page before this one is complete.
+        for (_, other) in self.pending:
+            if other is page:
+                break
+            other.finish(self.client)
+
+    def check(self, page):
+        if self.known and self.step <= len(page.results):
+            page.finish(self.client)
+
+    def take(self, offset, response):
+        """Returns the new results of the response to the page at the offset."""
+        self.pending.popleft()
+        if isinstance(response, update.Failure):
+            self.close()
+            raise RequestFailed(response)
+        results = response
+        if len(results) < 50:
+            self.end = offset + len(results)
+            while self.pending and self.end <= self.pending[-1][0]:
+                self.pending.pop()[1].future.cancel()
+        else:
+            # Only the last page may be shorter than the server's page size.
+            self.known = True
+            if self.step < len(results):
+                self.step = len(results)
+                self.next = max(self.next, offset + len(results))
+        fresh = results[max(0, self.position - offset):]
+        self.position = max(self.position, offset + len(results))
+        return [make_result(result) for result in fresh]
+
+    def close(self):
+        while self.pending:
+            (_, page) = self.pending.pop()
+            page.future.cancel()
+            if page.id is not None:
+                self.client.callbacks.pop(page.id, None)
+        self.end = self.position
+
 class Channel:
     """Representation of a channel the client is in.
 
-    Channels have a name, a list of users, and a dictionary
+    Channels have a name, a set of users, and a dictionary
     of channel information that is stored on servers with the
     shirakumo-channel-info extension.
 
+    The users are kept as IDs in a UserRegistry. Clients pass
+    their own, otherwise a registry shared by all channels is
+    used.
+    When the channel's users are synchronised with a Users
+    update, changes holds the lists of users that joined and
+    that left since the previous synchronisation.
+
     You may access the channel information by accessing the
     channel object like a dictionary.
     """
-    __slots__ = 'name', 'users', 'info'
+    __slots__ = 'name', 'users', 'info', 'changes'
 
-    def __init__(self, name):
+    def __init__(self, name, registry=None):
         self.name = name
-        self.users = CaseInsensitiveSet()
+        self.users = UserSet(user_registry if registry is None else registry)
         self.info = {}
+        self.changes = ([], [])
 
     def join(self, name):
         self.users.add(name)
@@ -64,6 +235,10 @@ class Channel:
     def leave(self, name):
         self.users.discard(name)
 
+    def sync(self, names):
+        self.changes = self.users.sync(names)
+        return self.changes
+
     def __getitem__(self, key):
         return self.info.get(key)
 
@@ -71,36 +246,6 @@ class Channel:
         self.info[key] = value
         return value
 
-class Emote:
-    """Representation of an emote the server sent back.
-
-    An emote has a name, a content_type (as a mime-type string)
-    and a binary payload that describes the actual image data
-    """
-    __slots__ = 'name', 'content_type', 'payload'
-
-    def __init__(self, name, content_type, payload):
-        self.name = name
-        self.content_type = content_type
-        self.payload = payload
-
-    def from_file(filename):
-        (content_type,_) = mimetypes.guess_type(filename, False)
-        if content_type == None:
-            return None
-        with open(filename, 'rb') as file:
-            name = Path(filename).stem
-            return Emote(name, content_type, file.read())
-
-    def offload(self, directory):
-        with open(directory+'/'+self.filename(), 'wb') as file:
-            file.write(self.payload)
-
-    def filename(self):
-        if not mimetypes.inited:
-            mimetypes.init()
-        return self.name+mimetypes.guess_extension(self.content_type, False)
-    
 class Client:
     """A basic Lichat client using TCP sockets.
 
@@ -123,6 +268,55 @@ class Client:
     When constructed the client will not attempt
     connection. Connection has to be manually
     initiated with the connect function.
+
+    By default send writes the update out before it
+    returns. If buffered is set to true, send only
+    queues the update, and queued updates are written
+    out together by flush, by recv, or once more than
+    flush_threshold bytes are queued.
+
+    Sent updates are remembered as in flight, and
+    callbacks kept, for in_flight_timeout seconds or
+    until a response arrives. For updates larger than
+    retain_limit bytes, only a copy without the long
+    string fields is remembered. Set retain_limit to
+    None to always keep the full update.
+
+    If limiter is set to a RateLimiter, send and send_callback
+    hold back updates that would exceed its rates, and the held
+    updates are sent out by recv or release_queued once the
+    limiter allows it. The limiter is adjusted automatically when
+    the server pauses a channel or reports being flooded.
+
+    The emotes can be kept in a persistent EmoteStore with
+    open_emotes, in which case only missing or stale emotes are
+    requested from the server, and payloads are only loaded
+    when they are accessed.
+
+    If executor is set to a concurrent.futures executor, handle
+    runs the handlers added with add_handler on it instead of
+    inline, so that slow handlers don't hold up receiving.
+    Updates with the same order_key, by default their channel,
+    are still handled one after the other in the order they
+    arrived. The client's own state keeping handlers and
+    callbacks always run inline. Sending is safe from handlers
+    running on the executor.
+
+    Received data is read into a buffer of window bytes, and
+    only the complete frames in it are parsed, while the start
+    of an incomplete frame is held back until the rest arrives.
+    A single frame larger than the window is parsed in pieces.
+
+    If decoder_pool is set to a ProcessPoolExecutor, and at
+    least batch_threshold bytes of frames arrive at once, for
+    instance as a flood of backfill or search results or as a
+    single huge frame, they are parsed in the pool's processes.
+    Smaller amounts are parsed inline as usual. The pool is not
+    used while payloads are streamed with stream_data.
+
+    If metrics is set to a Metrics instance, the client's
+    traffic, parse and serialisation times, and response
+    latencies are recorded in it, and can be read with stats.
     """
     __slots__ = ('username', 'password',
                  'servername',
@@ -130,12 +324,39 @@ class Client:
                  'extensions',
                  'id',
                  'socket',
-                 'chunks',
+                 'parser',
+                 'outgoing',
+                 'outgoing_start',
+                 'buffered',
+                 'flush_threshold',
                  'channels',
+                 'user_registry',
                  'emotes',
+                 'emote_store',
+                 'history',
+                 'index',
                  'callbacks',
                  'handlers',
-                 'in_flight')
+                 'dispatch',
+                 'in_flight',
+                 'in_flight_timeout',
+                 'retain_limit',
+                 'expiry',
+                 'limiter',
+                 'metrics',
+                 'executor',
+                 'order_key',
+                 'inline_handlers',
+                 'lanes',
+                 'lock',
+                 'decoder_pool',
+                 'batch_threshold',
+                 'batch_size',
+                 'window',
+                 'incoming',
+                 'incoming_view',
+                 'incoming_start',
+                 'incoming_end')
     
     def __init__(self, username=None, password=None):
         self.username = username
@@ -144,11 +365,38 @@ class Client:
         self.connected = False
         self.extensions = []
         self.id = (int(time.time()) << 16) + random.getrandbits(16)
-        self.chunks = []
+        self.parser = wire.Parser()
+        self.outgoing = bytearray()
+        self.outgoing_start = 0
+        self.buffered = False
+        self.flush_threshold = 65536
         self.channels = CaseInsensitiveDict()
+        self.user_registry = UserRegistry()
         self.emotes = CaseInsensitiveDict()
+        self.emote_store = None
+        self.history = None
+        self.index = None
         self.callbacks = {}
         self.in_flight = {}
+        self.in_flight_timeout = 600
+        self.retain_limit = 65536
+        self.expiry = []
+        self.dispatch = {}
+        self.limiter = None
+        self.metrics = None
+        self.executor = None
+        self.order_key = channel_key
+        self.lanes = {}
+        self.lock = threading.RLock()
+        self.decoder_pool = None
+        self.batch_threshold = 256*1024
+        self.batch_size = 64*1024
+        self.window = 512*1024
+        # The buffer is allocated on the first read, see make_room.
+        self.incoming = bytearray()
+        self.incoming_view = memoryview(self.incoming)
+        self.incoming_start = 0
+        self.incoming_end = 0
 
         def connect(self, u):
             self.connected = True
@@ -169,15 +417,16 @@ class Client:
             if self.servername == None:
                 self.servername = u.channel
                 if self.is_supported('shirakumo-emotes'):
-                    self.send_callback(swallow_errors, update.Emotes, names=list(self.emotes.keys()))
+                    self.send_callback(swallow_errors, update.Emotes, names=self.current_emotes())
 
             if self.is_my_own(u):
-                self.channels[u.channel] = Channel(u.channel)
+                self.channels[u.channel] = Channel(u.channel, self.user_registry)
                 self.send(update.Users, channel=u.channel)
                 if self.is_supported('shirakumo-channel-info'):
                     self.send_callback(swallow_errors, update.ChannelInfo, channel=u.channel, keys=True)
                 if self.is_supported('shirakumo-backfill'):
-                    self.send_callback(swallow_errors, update.Backfill, channel=u.channel)
+                    since = None if self.history is None else self.history.since(u.channel)
+                    self.send_callback(swallow_errors, update.Backfill, channel=u.channel, since=since)
 
             self.channels[u.channel].join(u['from'])
 
@@ -188,7 +437,12 @@ class Client:
                 self.channels[u.channel].leave(u['from'])
 
         def emote(self, u):
-            self.emotes[u.name] = Emote(u.name, u['content-type'], base64.b64decode(u.payload))
+            payload = base64.b64decode(u.payload)
+            if self.emote_store is not None:
+                self.emotes[u.name] = self.emote_store.add(u.name, u['content-type'], payload)
+            else:
+                from .emotes import Emote
+                self.emotes[u.name] = Emote(u.name, u['content-type'], payload)
 
         def channelinfo(self, u):
             channel = self.channels.get(u.channel, None)
@@ -198,11 +452,28 @@ class Client:
         def users(self, u):
             channel = self.channels.get(u.channel, None)
             if channel != None:
-                for user in u.users:
-                    channel.join(user)
+                channel.sync(u.users)
+
+        def pause(self, u):
+            if self.limiter is not None:
+                self.limiter.pause(u.channel, u.by)
+
+        def throttle(self, u):
+            if self.limiter is not None:
+                self.limiter.throttle()
+
+        def record(self, u):
+            if self.history is not None:
+                self.history.record(u)
+
+        def message(self, u):
+            if self.index is not None:
+                self.index.add(u)
             
         self.handlers = {
             update.Update: [],
+            update.ChannelUpdate: [record],
+            update.Message: [message],
             update.Connect: [connect],
             update.Disconnect: [disconnect],
             update.Ping: [ping],
@@ -210,8 +481,13 @@ class Client:
             update.Leave: [leave],
             update.Emote: [emote],
             update.SetChannelInfo: [channelinfo],
-            update.Users: [users]
+            update.Users: [users],
+            update.Pause: [pause],
+            update.TooManyUpdates: [throttle],
+            update.ConnectionUnstable: [throttle],
+            update.TooManyConnections: [throttle]
         }
+        self.inline_handlers = {handler for handlers in self.handlers.values() for handler in handlers}
 
     def add_handler(self, update, fun):
         """Adds a handler function for the given update type.
@@ -219,15 +495,37 @@ class Client:
         Supplied to the handler function are the client
         and the update objects. add_handler expects an Update
         class as argument for which the handler function
-        is invoked. Note that only exact type matches are
-        dispatched, the class hierarchy is ignored. You
-        may however install a handler on Update, which
-        will be invoked for every update, regardless of
-        actual type.
+        is invoked. The handler is invoked for updates of that
+        class and of all of its subclasses, so a handler on
+        Failure sees every failure, and a handler on Update
+        sees every update. Handlers on more specific classes
+        are invoked first.
         """
         if update not in self.handlers:
             self.handlers[update] = []
         self.handlers[update].append(fun)
+        self.dispatch.clear()
+
+    def remove_handler(self, update, fun):
+        """Removes a handler function previously added with add_handler."""
+        handlers = self.handlers.get(update, [])
+        if fun in handlers:
+            handlers.remove(fun)
+        self.dispatch.clear()
+
+    def find_handlers(self, clazz):
+        """Returns the list of handler functions to invoke for the update class.
+
+        The list is computed once per class and cached until the
+        handlers change.
+        """
+        handlers = self.dispatch.get(clazz, None)
+        if handlers is None:
+            handlers = []
+            for superclass in update.superclasses(clazz):
+                handlers += self.handlers.get(superclass, [])
+            self.dispatch[clazz] = handlers
+        return handlers
 
     def clock():
         """Returns the current time in universal-time"""
@@ -235,8 +533,9 @@ class Client:
 
     def next_id(self):
         """Returns a new unique ID."""
-        self.id = self.id+1
-        return self.id
+        with self.lock:
+            self.id = self.id+1
+            return self.id
 
     def is_supported(self, extension):
         """Returns true if the given extension is supported by client and server."""
@@ -244,16 +543,50 @@ class Client:
 
     def offload_emotes(self, directory):
         """Writes all emotes as files to the given directory."""
-        for emote in self.emotes:
+        for emote in self.emotes.values():
             emote.offload(directory)
-    
+
     def reload_emotes(self, directory):
         """Load all files from the directory into the emote database."""
+        from .emotes import Emote
         for path in os.listdir(directory):
             emote = Emote.from_file(directory+'/'+path)
             if emote != None:
                 self.emotes[emote.name] = emote
 
+    def open_emotes(self, directory, memory_limit=16*1024*1024, max_age=None):
+        """Keep the emote database in a persistent EmoteStore in the directory.
+
+        The emotes already in the store are loaded, and emotes
+        received from now on are added to it.
+
+        See EmoteStore
+        """
+        from .emotes import EmoteStore
+        self.emote_store = EmoteStore(directory, memory_limit=memory_limit, max_age=max_age)
+        for emote in self.emote_store.emotes():
+            self.emotes[emote.name] = emote
+        return self.emote_store
+
+    def open_history(self, path, commit_size=256, commit_interval=1.0):
+        """Record the history of joined channels in a HistoryStore at the path.
+
+        Channel updates received from now on are stored, and the
+        backfill requested when joining a channel only asks for
+        updates since the last one recorded for it.
+
+        See HistoryStore
+        """
+        from .history import HistoryStore
+        self.history = HistoryStore(path, commit_size=commit_size, commit_interval=commit_interval)
+        return self.history
+
+    def current_emotes(self):
+        """Returns the names of the known emotes that do not need to be fetched again."""
+        if self.emote_store is None:
+            return list(self.emotes)
+        return [name for name in self.emotes if name not in self.emote_store or not self.emote_store.is_stale(name)]
+
     def connect(self, host, port=None, timeout=10.0, username=None, password=None, ssl=False, ssl_options={}):
         """Attempts to establish a connection to the given server.
 
@@ -302,14 +635,29 @@ class Client:
             self.connected = False
 
     def disconnect_raw(self):
-        self.connected = False
-        self.channels.clear()
-        self.chunks = []
-        self.extensions = []
-        if self.socket is not None:
-            self.socket.close()
-            self.socket = None
-            self.callbacks = {}
+        pending = []
+        with self.lock:
+            self.connected = False
+            self.channels.clear()
+            self.parser.reset()
+            self.incoming_start = 0
+            self.incoming_end = 0
+            del self.outgoing[:]
+            self.outgoing_start = 0
+            self.extensions = []
+            if self.limiter is not None:
+                self.limiter.clear()
+            if self.history is not None:
+                self.history.commit()
+            if self.socket is not None:
+                self.socket.close()
+                self.socket = None
+                pending = [callback for (callback, _) in self.callbacks.values() if isinstance(callback, PendingRequest)]
+                self.callbacks = {}
+        # Futures run their done callbacks right away, so fail them
+        # only once the lock is released.
+        for callback in pending:
+            callback.fail(ConnectionLost())
 
     def make_instance(self, type, **args):
         """Creates an update instance with default values for from/clock/id.
@@ -329,9 +677,8 @@ class Client:
         if self.socket is None:
             raise ConnectionLost("not connected")
         instance = self.make_instance(type, **args)
-        self.in_flight[instance.id] = instance
         logger.debug(f"sending {instance!r}")
-        self.send_raw(wire.to_string(instance.to_list()))
+        self.submit(instance)
         return instance.id
 
     def send_callback(self, callback, type, **args):
@@ -347,12 +694,237 @@ class Client:
         if self.socket is None:
             raise ConnectionLost("not connected")
         instance = self.make_instance(type, **args)
-        self.in_flight[instance.id] = instance
         logger.debug(f"sending (with callback) {instance!r}")
-        self.callbacks[instance.id] = (callback, instance)
-        self.send_raw(wire.to_string(instance.to_list()))
+        self.submit(instance, callback)
+        return instance.id
+
+    def send_request(self, type, timeout=None, **args):
+        """Sends a new update and returns a future for the response.
+
+        The future is resolved with the response update, which
+        may also be an UpdateFailure. If no response arrives
+        within timeout seconds, or in_flight_timeout if no timeout
+        is given, the future fails with a TimeoutError. If the
+        connection is lost, it fails with ConnectionLost. Cancelling
+        the future stops waiting for the response.
+
+        The future is resolved from handle, so something needs to
+        keep receiving and handling updates, either another thread
+        or wait.
+
+        See send_callback
+        """
+        return self.send_pending(PendingRequest(self.make_future()), type, timeout=timeout, **args)
+
+    def send_pending(self, pending, type, timeout=None, **args):
+        """Sends a new update with a PendingRequest as its callback and returns its future.
+
+        See send_request
+        """
+        if self.socket is None:
+            raise ConnectionLost("not connected")
+        instance = self.make_instance(type, **args)
+        logger.debug(f"sending (with request) {instance!r}")
+        future = pending.future
+        if timeout is not None:
+            pending.timeout = timeout
+        self.submit(instance, pending)
+        id = instance.id
+        def forget(future):
+            if future.cancelled():
+                self.callbacks.pop(id, None)
+        future.add_done_callback(forget)
+        return future
+
+    def make_future(self):
+        import concurrent.futures
+        return concurrent.futures.Future()
+
+    def search(self, channel, query, prefetch=2, timeout=None):
+        """Search the history of the channel and return an iterator over the results.
+
+        The query is a list of alternating field symbols and values
+        as for the query field of the Search update. Results are
+        yielded as update instances, in order of their clock. Pages
+        are requested lazily, keeping up to prefetch pages in flight
+        ahead of the one being read, so that reading through many
+        pages is not held up by a round trip for each. Updates are
+        received and handled while waiting for a page, as in wait.
+
+        If the server responds with a failure, a RequestFailed is
+        raised. Closing the iterator early stops requesting pages.
+
+        See SearchPages
+        """
+        pages = SearchPages(self, channel, query, prefetch=prefetch, timeout=timeout)
+        try:
+            while not pages.done():
+                (offset, future) = pages.head()
+                for result in pages.take(offset, self.wait(future)):
+                    yield result
+        finally:
+            pages.close()
+
+    def wait(self, future, timeout=None):
+        """Receive and handle updates until the future is done, and return its result.
+
+        Raises a TimeoutError if the future is not done within
+        timeout seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not future.done():
+            remaining = 1.0 if deadline is None else deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError("No response within the timeout.")
+            if self.socket is None:
+                raise ConnectionLost("not connected")
+            for instance in self.recv(min(remaining, 1.0)):
+                self.handle(instance)
+            self.expire()
+        return future.result()
+
+    def submit(self, instance, callback=None):
+        with self.lock:
+            if self.limiter is not None and not self.limiter.admit(instance):
+                logger.debug(f"rate limited {instance!r}")
+                self.limiter.enqueue(instance, callback)
+            else:
+                self.transmit(instance, callback)
+
+    def transmit(self, instance, callback=None):
+        if is_streamed(instance):
+            size = self.send_streamed(instance)
+        else:
+            size = self.send_update(instance)
+        if self.metrics is not None:
+            self.metrics.sent(instance, size)
+        timeout = callback.timeout if isinstance(callback, PendingRequest) else None
+        record = self.track(instance, size, timeout)
+        if callback is not None:
+            self.callbacks[instance.id] = (callback, record)
+
+    def send_file(self, channel, path, content_type=None, filename=None, **args):
+        """Sends the file at the path to the channel as a data update.
+
+        The file is read, encoded, and sent in chunks, so it is
+        never held in memory as a whole. The content type is guessed
+        from the path, and the filename defaults to the path's name.
+        While the file is being sent, send blocks even if the client
+        is buffered.
+
+        See PayloadFile
+        """
+        if self.socket is None:
+            raise ConnectionLost("not connected")
+        instance = self.make_file_instance(channel, path, content_type, filename, **args)
+        logger.debug(f"sending {instance!r}")
+        self.submit(instance)
         return instance.id
 
+    def make_file_instance(self, channel, path, content_type=None, filename=None, **args):
+        # Fail right away if the file can't be read, rather than once it is sent.
+        open(path, 'rb').close()
+        if content_type is None:
+            (content_type, _) = mimetypes.guess_type(path, False)
+        args['content-type'] = content_type or 'application/octet-stream'
+        args['filename'] = filename or os.path.basename(path)
+        return self.make_instance(update.Data, channel=channel, payload=PayloadFile(path), **args)
+
+    def stream_data(self, open_file):
+        """Receive the payloads of data updates into files instead of strings.
+
+        open_file is called without arguments whenever the payload
+        of a data update starts arriving, and has to return a binary
+        file object to write to. The payload is decoded into the
+        file as it arrives, and the update's payload is then a
+        PayloadSink holding the file. Pass None to receive payloads
+        as strings again.
+        """
+        if open_file is None:
+            self.parser.sink = None
+            return
+        data = update.Data.__symbol__
+        payload = symbol.kw('payload')
+        def sink(items):
+            if items[0] == data and items[-1] == payload and len(items) % 2 == 0:
+                return PayloadSink(open_file())
+            return None
+        self.parser.sink = sink
+
+    def release_queued(self):
+        """Send out the updates held back by the limiter that may be sent now.
+
+        Returns the number of seconds until the next held update
+        may be sent, or None if no updates are held back.
+        """
+        if self.limiter is None:
+            return None
+        with self.lock:
+            if self.socket is not None:
+                for (instance, callback) in self.limiter.release():
+                    self.transmit(instance, callback)
+            return self.limiter.next_delay()
+
+    def queue_depth(self, channel=None):
+        """Returns the number of updates held back by the limiter.
+
+        If a channel name is given, only messages for that
+        channel are counted.
+        """
+        if self.limiter is None:
+            return 0
+        return self.limiter.depth(channel)
+
+    def track(self, instance, size=0, timeout=None):
+        """Remember the sent update as in flight until it expires.
+
+        It expires after timeout seconds, or in_flight_timeout if
+        no timeout is given.
+
+        If the update's size in bytes was larger than retain_limit,
+        a copy without its long string fields is remembered instead.
+        Returns the remembered record.
+        """
+        record = instance
+        if self.retain_limit is not None and self.retain_limit < size:
+            record = copy.copy(instance)
+            for key in record:
+                value = record[key]
+                if isinstance(value, str) and self.retain_limit < len(value):
+                    record[key] = None
+        self.in_flight[instance.id] = record
+        if timeout is None:
+            timeout = self.in_flight_timeout
+        heapq.heappush(self.expiry, (time.monotonic() + timeout, instance.id))
+        return record
+
+    def expire(self):
+        """Forget in-flight updates and callbacks whose time has run out."""
+        expiry = self.expiry
+        now = time.monotonic()
+        if not expiry or now < expiry[0][0]:
+            return
+        with self.lock:
+            while expiry and expiry[0][0] <= now:
+                (_, id) = heapq.heappop(expiry)
+                self.in_flight.pop(id, None)
+                (callback, _) = self.callbacks.pop(id, (None, None))
+                if isinstance(callback, PendingRequest):
+                    callback.fail(TimeoutError("No response within the timeout."))
+                if self.metrics is not None:
+                    self.metrics.expired(id)
+
+    def stats(self):
+        """Returns a snapshot of the client's metrics as a dictionary.
+
+        If no metrics are being recorded, None is returned.
+
+        See Metrics
+        """
+        if self.metrics is None:
+            return None
+        return self.metrics.snapshot()
+
     def recv(self, timeout=0):
         """Receive updates.
 
@@ -361,13 +933,33 @@ class Client:
         time to wait for updates. Note that this function may
         return even if there are more updates ready to be read.
         """
-        strings = self.recv_raw(timeout)
+        return self.make_updates(self.recv_raw(timeout))
+
+    def recv_ready(self):
+        """Receive the updates that can be read without waiting.
+
+        This does not check whether the socket is ready, so it is
+        meant to be called once something else, like a selector,
+        has reported the socket as readable.
+        """
+        return self.make_updates(self.read_raw())
+
+    def make_updates(self, values):
         updates = []
-        for string in strings:
-            (update, _i) = read_update(string)
-            if update != None:
-                logger.debug(f"received {update!r}")
-                updates.append(update)
+        for dat in values:
+            instance = make_update(dat)
+            if instance is None:
+                continue
+            if self.parser.sink is not None and is_broken(instance):
+                # Only this update is lost, the frame itself was read fine.
+                logger.warning(f"dropped {instance!r}, its payload is not valid base64")
+                instance.payload.file.close()
+                continue
+            logger.debug(f"received {instance!r}")
+            updates.append(instance)
+        if self.metrics is not None:
+            for instance in updates:
+                self.metrics.received_update(instance)
         return updates
 
     def handle(self, instance):
@@ -381,24 +973,73 @@ class Client:
             id = instance.id
         elif isinstance(instance, update.UpdateFailure):
             id = instance['update-id']
+        elif isinstance(instance, update.Pong):
+            id = instance.id
         (callback, sent) = self.callbacks.pop(id, (None, None))
+        if self.metrics is not None and id is not None:
+            self.metrics.responded(id)
 
+        deferred = False
         try:
             if callback != None:
                 callback(self, sent, instance)
-            for handler in self.handlers.get(instance.__class__, []):
-                handler(self, instance)
-            for handler in self.handlers[update.Update]:
-                handler(self, instance)
+            if self.executor is None:
+                for handler in self.find_handlers(instance.__class__):
+                    handler(self, instance)
+            else:
+                handlers = []
+                for handler in self.find_handlers(instance.__class__):
+                    if handler in self.inline_handlers:
+                        handler(self, instance)
+                    else:
+                        handlers.append(handler)
+                if handlers:
+                    self.defer(instance, handlers, id)
+                    deferred = True
 
         except SwallowUpdate:
             logger.debug("update swallowed by a handler", exc_info=True)
             pass
         finally:
-            self.in_flight.pop(id, None)
-            for id in list(self.in_flight):
-                if 600 < (Client.clock() - self.in_flight[id].clock):
-                    del self.in_flight[id]
+            # Deferred handlers still need the origin, their lane forgets it.
+            if not deferred:
+                self.in_flight.pop(id, None)
+            self.expire()
+
+    def defer(self, instance, handlers, id=None):
+        """Run the handlers for the update on the executor.
+
+        Updates with the same order key are queued up in a lane,
+        which is worked off by a single task at a time. The update
+        in flight under id, if any, is forgotten once the handlers
+        have run.
+        """
+        key = self.order_key(instance)
+        with self.lock:
+            lane = self.lanes.get(key, None)
+            if lane is not None:
+                lane.append((instance, handlers, id))
+                return
+            self.lanes[key] = collections.deque()
+        self.executor.submit(self.run_lane, key, instance, handlers, id)
+
+    def run_lane(self, key, instance, handlers, id=None):
+        while True:
+            try:
+                for handler in handlers:
+                    handler(self, instance)
+            except SwallowUpdate:
+                logger.debug("update swallowed by a handler", exc_info=True)
+            except Exception:
+                logger.exception(f"handler failed for {instance!r}")
+            with self.lock:
+                if id is not None:
+                    self.in_flight.pop(id, None)
+                lane = self.lanes[key]
+                if not lane:
+                    del self.lanes[key]
+                    return
+                (instance, handlers, id) = lane.popleft()
 
     def origin(self, instance):
         """
@@ -406,7 +1047,8 @@ class Client:
         
         This can only be accessed while the response update is
         being handled, as the initial update reference is deleted
-        after the response has been fully handled.
+        after the response has been fully handled. With an executor,
+        that is once the handlers run on it have finished as well.
         """
         id = instance.id
         if isinstance(instance, update.UpdateFailure):
@@ -440,54 +1082,319 @@ class Client:
         self.socket.connect((host, port))
         self.socket.setblocking(0)
 
-    def send_raw(self, string):
-        totalsent = 0
-        binary = string.encode('utf-8') + b'\0'
-        length = len(binary)
-        while totalsent < length:
+    def send_update(self, instance):
+        outgoing = self.outgoing
+        size = len(outgoing)
+        try:
+            if self.metrics is None:
+                wire.write_bytes(instance.to_list(), outgoing)
+            else:
+                start = time.perf_counter()
+                wire.write_bytes(instance.to_list(), outgoing)
+                self.metrics.serialize.add(time.perf_counter() - start)
+        except:
+            # Don't leave a partial frame to corrupt the next one.
+            del outgoing[size:]
+            raise
+        outgoing.append(0)
+        size = len(outgoing) - size
+        self.queued()
+        return size
+
+    def send_streamed(self, instance):
+        size = 0
+        start = len(self.outgoing)
+        flushed = False
+        try:
+            for size in write_streamed(instance, self.outgoing):
+                if self.flush_threshold <= self.pending_output():
+                    self.flush(True)
+                    flushed = True
+        except ConnectionLost:
+            raise
+        except:
+            if not flushed:
+                del self.outgoing[start:]
+                raise
+            # Part of the frame is already out, the stream cannot recover.
+            self.disconnect_raw()
+            raise ConnectionLost("failed to send payload")
+        self.queued()
+        return size
+
+    def send_raw(self, binary):
+        if isinstance(binary, str):
+            binary = binary.encode('utf-8') + b'\0'
+        with self.lock:
+            self.outgoing += binary
+            if self.metrics is not None:
+                self.metrics.sent_raw(len(binary))
+            self.queued()
+
+    def queued(self):
+        if not self.buffered:
+            self.flush(True)
+        elif self.flush_threshold <= self.pending_output():
+            self.flush()
+
+    def pending_output(self):
+        """Returns the number of queued bytes that have not been sent yet."""
+        return len(self.outgoing) - self.outgoing_start
+
+    def flush(self, block=False):
+        """Send out the queued updates.
+
+        All queued data is handed to the socket in as few calls as
+        the socket allows. If block is false, this stops once the
+        socket would block. Returns true if everything was sent.
+        """
+        with self.lock:
+            return self.flush_locked(block)
+
+    def flush_locked(self, block):
+        outgoing = self.outgoing
+        if self.socket is None:
+            raise ConnectionLost("not connected")
+        while self.outgoing_start < len(outgoing):
             try:
-                sent = self.socket.send(binary[totalsent:])
-                if sent == 0:
-                    self.disconnect_raw()
-                    raise ConnectionLost("sent == 0")
-                totalsent = totalsent + sent
-            except socket.error as e:
-                if e.errno != errno.EAGAIN:
-                    self.disconnect_raw()
-                    raise ConnectionLost("send error")
-                select.select([], [self.socket], [])
-        
+                with memoryview(outgoing) as view:
+                    sent = self.socket.send(view[self.outgoing_start:])
+            except (BlockingIOError, ssl.SSLWantWriteError, ssl.SSLWantReadError):
+                if not block:
+                    break
+                wait_socket(self.socket, False, True)
+                continue
+            except socket.error:
+                self.disconnect_raw()
+                raise ConnectionLost("send error")
+            if sent == 0:
+                self.disconnect_raw()
+                raise ConnectionLost("sent == 0")
+            self.outgoing_start = self.outgoing_start + sent
+        if self.outgoing_start == len(outgoing):
+            del outgoing[:]
+            self.outgoing_start = 0
+            return True
+        # Only move the unsent rest to the front once it is worth it.
+        if len(outgoing) < 2*self.outgoing_start:
+            del outgoing[:self.outgoing_start]
+            self.outgoing_start = 0
+        return False
+
     def recv_raw(self, timeout=0):
-        updates = []
-        errored = False
+        values = []
+        deadline = time.monotonic() + timeout
+        while not values:
+            try:
+                wait = max(0, deadline - time.monotonic())
+                self.expire()
+                delay = self.release_queued()
+                if delay is not None and delay < wait:
+                    wait = delay
+                if self.pending_output():
+                    self.flush()
+                (readable, writable, errored) = wait_socket(self.socket, True, 0 < self.pending_output(), wait)
+            except:
+                errored = True
+            if errored: return values + [self.lost_connection()]
+            if not readable and not writable and deadline <= time.monotonic(): break
+            if readable: values = self.read_raw()
+        return values
+
+    def read_raw(self):
+        """Read and parse whatever data is available on the socket without waiting.
+
+        At most about a window, or batch_threshold bytes if that is
+        larger, is read per call, so that a flood of data does not
+        keep the caller from handling what was received.
+
+        Returns the list of values that were completed. If the
+        connection was lost, a disconnect is included at the end.
+        """
+        # What is available is read before parsing, so that a flood
+        # of frames can be decoded as one batch.
+        values = []
+        lost = False
+        budget = max(self.window, self.batch_threshold)
         try:
-            ready = select.select([self.socket], [], [self.socket], timeout)
-            if ready[2]: errored = True
-            if ready[0]:
-                found_end = False
-                chunk = self.socket.recv(4096).decode('utf-8')
-                if len(chunk) == 0:
-                    errored = True
-                while 0 < len(chunk):
-                    self.chunks.append(chunk)
-                    if '\0' in chunk:
-                        found_end = True
-                        break
-                    ready = select.select([self.socket], [], [self.socket])
-                    if ready[2]: errored = True
-                    if ready[0]: chunk = self.socket.recv(4096).decode('utf-8')
-                    elif errored: break
-                if found_end:
-                    updates += self.stitch()
+            while 0 < budget:
+                self.make_room()
+                try:
+                    count = self.socket.recv_into(self.incoming_view[self.incoming_end:])
+                except (BlockingIOError, ssl.SSLWantReadError):
+                    break
+                if count == 0:
+                    lost = True
+                    break
+                self.incoming_end = self.incoming_end + count
+                budget = budget - count
+                if self.incoming_end == len(self.incoming):
+                    values += self.feed(self.take_frames())
+            values += self.feed(self.take_frames())
         except:
-            errored = True
-        if errored: updates += [f"(disconnect :from \"{self.servername}\" :id 0)"]
-        return updates
+            lost = True
+        if lost:
+            values.append(self.lost_connection())
+        return values
+
+    def make_room(self):
+        # Only once the window is full is the incomplete frame at its
+        # end moved to the start, so that this copy is rare.
+        start = self.incoming_start
+        end = self.incoming_end
+        if start == end:
+            self.incoming_start = self.incoming_end = 0
+            if len(self.incoming) != self.window:
+                self.incoming_view.release()
+                self.incoming = bytearray(self.window)
+                self.incoming_view = memoryview(self.incoming)
+        elif end == len(self.incoming):
+            self.incoming[:end-start] = self.incoming_view[start:end]
+            self.incoming_start = 0
+            self.incoming_end = end-start
+
+    def take_frames(self):
+        """Returns a view of the complete frames in the receive buffer, and drops them from it.
+
+        If the buffer is full with a single incomplete frame, that
+        is returned instead, to be parsed in pieces. The view is
+        only valid until more data is read into the buffer.
+        """
+        start = self.incoming_start
+        end = self.incoming_end
+        last = self.incoming.rfind(b'\0', start, end)
+        if last < 0:
+            if start != 0 or end != len(self.incoming):
+                return self.incoming_view[0:0]
+            last = end-1
+        self.incoming_start = last+1
+        return self.incoming_view[start:last+1]
+
+    def feed(self, data):
+        """Parse received bytes and return the list of completed values.
+
+        If a decoder_pool is set and the bytes are at least
+        batch_threshold bytes worth of complete frames, the frames
+        are split into batches of about batch_size bytes that are
+        parsed by the pool in parallel.
+        """
+        if not self.is_batch(data):
+            return self.parse(data)
+        data = bytes(data)
+        start = time.perf_counter()
+        results = self.decoder_pool.map(decode_frames, split_frames(data, self.batch_size))
+        return self.collect(results, len(data), start)
+
+    def is_batch(self, data):
+        return (self.decoder_pool is not None
+                and 0 < len(data)
+                and self.batch_threshold <= len(data)
+                and data[-1] == 0
+                and self.parser.sink is None
+                and self.parser.state == wire.Parser.START)
+
+    def parse(self, chunk):
+        if not chunk:
+            return []
+        if self.metrics is None:
+            return self.parser.feed(chunk)
+        start = time.perf_counter()
+        values = self.parser.feed(chunk)
+        self.metrics.received(len(chunk), len(values), time.perf_counter() - start)
+        return values
+
+    def collect(self, results, size, start):
+        values = []
+        for result in results:
+            values += result
+        if self.metrics is not None:
+            self.metrics.received(size, len(values), time.perf_counter() - start)
+        return values
+
+    def lost_connection(self):
+        return wire.from_string(f"(disconnect :from \"{self.servername}\" :id 0)")[0]
+
+def __getattr__(name):
+    # The emote and history stores are only loaded once they are used,
+    # to keep the import cheap.
+    if name in ('Emote', 'EmoteStore'):
+        from . import emotes
+        return getattr(emotes, name)
+    if name == 'HistoryStore':
+        from . import history
+        return history.HistoryStore
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def decode_frames(data):
+    """Parse the complete frames in the bytes and return their values.
+
+    This is run in the processes of a client's decoder_pool. The
+    values are sent back as plain lists, and symbols are interned
+    again when they are unpickled.
+    """
+    return wire.Parser().feed(data)
+
+def split_frames(data, size):
+    """Split the bytes of complete frames into pieces of about size bytes, at frame boundaries."""
+    pieces = []
+    start = 0
+    while start < len(data):
+        end = data.find(b'\0', min(start+size, len(data)) - 1)
+        if end < 0:
+            end = len(data) - 1
+        pieces.append(data[start:end+1])
+        start = end+1
+    return pieces
+
+def make_result(result):
+    # Search results are sent as plain lists, turn them into updates where possible.
+    if isinstance(result, list) and result and isinstance(result[0], symbol.Symbol):
+        instance = update.make_instance_plist(result[0], result[1:])
+        if instance is not None:
+            return instance
+    return result
+
+def channel_key(instance):
+    """Returns the casefolded channel of the update, or None if it has none."""
+    if 'channel' in instance.__slotmap__ and instance.channel is not None:
+        return instance.channel.casefold()
+    return None
+
+def wait_socket(sock, read=True, write=False, timeout=None):
+    """Wait until the socket is ready for reading or writing.
+
+    Returns a tuple of whether the socket is readable, whether it
+    is writable, and whether it has errored. Uses poll where
+    available, which unlike select is not limited to file
+    descriptors below FD_SETSIZE.
+    """
+    if hasattr(select, 'poll'):
+        poller = select.poll()
+        poller.register(sock, (select.POLLIN if read else 0) | (select.POLLOUT if write else 0))
+        if timeout is not None:
+            timeout = timeout * 1000
+        ready = 0
+        for (_, ready) in poller.poll(timeout):
+            pass
+        errored = bool(ready & (select.POLLERR | select.POLLNVAL))
+        return (bool(ready & (select.POLLIN | select.POLLHUP)), bool(ready & select.POLLOUT), errored)
+    ready = select.select([sock] if read else [], [sock] if write else [], [sock], timeout)
+    return (bool(ready[0]), bool(ready[1]), bool(ready[2]))
+
+def make_update(dat):
+    """Turn a value read from the wire into an update instance.
 
-    def stitch(self):
-        parts = ''.join(self.chunks).split('\0')
-        self.chunks = [parts.pop()]
-        return parts
+    If the value does not describe an update, None is returned.
+    """
+    if type(dat) == list and 0 < len(dat):
+        return update.make_instance_plist(dat[0], dat[1:])
+    return None
+
+def is_broken(instance):
+    """Returns true if the update's payload was streamed into a file but could not be decoded."""
+    return (isinstance(instance, update.Data)
+            and isinstance(instance.payload, PayloadSink)
+            and instance.payload.error is not None)
 
 def read_update(string, i=0):
     """Parse an update from the string.
@@ -497,8 +1404,12 @@ def read_update(string, i=0):
     If no update can be parsed or the item is not an update,
     None is returned instead of the update
     """
-    (dat, i) = wire.from_string(string, i)
-    if type(dat) == list and 0 < len(dat):
-        instance = update.make_instance_plist(dat[0], dat[1:])
-        return (instance, i)
-    return (None, i)    
+    parser = wire.Parser()
+    values = parser.parse(string, i, count=1) or parser.finish()
+    if values:
+        return (make_update(values[0]), parser.position)
+    return (None, parser.position)
+
+# The stores are listed as well, so that a star import loads them
+# through __getattr__.
+__all__ = sorted([name for name in globals() if not name.startswith('_')] + ['Emote', 'EmoteStore', 'HistoryStore'])
@@ -0,0 +1,193 @@
+from .toolkit import *
+from pathlib import Path
+import collections
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+import time
+
+class Emote:
+    """Representation of an emote the server sent back.
+
+    An emote has a name, a content_type (as a mime-type string)
+    and a binary payload that describes the actual image data.
+
+    Emotes read from an EmoteStore or from a file only load
+    their payload once it is first accessed.
+    """
+    __slots__ = 'name', 'content_type', 'digest', 'source', 'data'
+
+    def __init__(self, name, content_type, payload=None, digest=None, source=None):
+        self.name = name
+        self.content_type = content_type
+        self.digest = digest
+        self.source = source
+        self.data = payload
+
+    @property
+    def payload(self):
+        if self.data is not None:
+            return self.data
+        if isinstance(self.source, EmoteStore):
+            return self.source.read(self.digest)
+        if self.source is not None:
+            with open(self.source, 'rb') as file:
+                return file.read()
+        return None
+
+    @payload.setter
+    def payload(self, value):
+        self.data = value
+        self.digest = None
+        self.source = None
+
+    def from_file(filename):
+        (content_type,_) = mimetypes.guess_type(filename, False)
+        if content_type == None:
+            return None
+        name = Path(filename).stem
+        return Emote(name, content_type, source=filename)
+
+    def offload(self, directory):
+        target = directory+'/'+self.filename()
+        if self.data is None and isinstance(self.source, EmoteStore):
+            shutil.copyfile(self.source.path(self.digest), target)
+        else:
+            with open(target, 'wb') as file:
+                file.write(self.payload)
+
+    def filename(self):
+        if not mimetypes.inited:
+            mimetypes.init()
+        return self.name+mimetypes.guess_extension(self.content_type, False)
+
+class EmoteStore:
+    """A persistent, content-addressed emote database in a directory.
+
+    Payloads are stored once per SHA-256 digest under objects/,
+    and an append-only index maps emote names to their content
+    type, digest, and the time they were last received. The index
+    is compacted once it has grown to twice its live size.
+
+    Payloads are only read from disk when an emote's payload is
+    accessed, and at most memory_limit bytes of them are kept in
+    memory, evicting the least recently used ones first.
+
+    If max_age is set, emotes that were last received more than
+    max_age seconds ago count as stale, so that they are fetched
+    again from the server.
+    """
+    __slots__ = 'directory', 'entries', 'memory_limit', 'max_age', 'cache', 'cached', 'records'
+
+    def __init__(self, directory, memory_limit=16*1024*1024, max_age=None):
+        self.directory = directory
+        self.entries = CaseInsensitiveDict()
+        self.memory_limit = memory_limit
+        self.max_age = max_age
+        self.cache = collections.OrderedDict()
+        self.cached = 0
+        self.records = 0
+        os.makedirs(os.path.join(directory, 'objects'), exist_ok=True)
+        self.load()
+
+    def path(self, digest):
+        return os.path.join(self.directory, 'objects', digest)
+
+    def index(self):
+        return os.path.join(self.directory, 'index')
+
+    def load(self):
+        self.entries.clear()
+        self.records = 0
+        try:
+            with open(self.index(), 'r', encoding='utf-8') as file:
+                for line in file:
+                    try:
+                        (name, content_type, digest, stamp) = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.records = self.records+1
+                    if digest is None:
+                        self.entries.pop(name, None)
+                    else:
+                        self.entries[name] = (content_type, digest, stamp)
+        except FileNotFoundError:
+            pass
+
+    def append(self, name, entry):
+        with open(self.index(), 'a', encoding='utf-8') as file:
+            file.write(json.dumps([name, *entry])+'\n')
+        self.records = self.records+1
+        if 64 + 2*len(self.entries) < self.records:
+            self.compact()
+
+    def compact(self):
+        """Rewrite the index with only the live entries."""
+        temp = f"{self.index()}.{os.getpid()}.tmp"
+        with open(temp, 'w', encoding='utf-8') as file:
+            for name in self.entries:
+                file.write(json.dumps([name, *self.entries[name]])+'\n')
+        os.replace(temp, self.index())
+        self.records = len(self.entries)
+
+    def add(self, name, content_type, payload):
+        """Store the emote and return it as a lazily loaded Emote."""
+        digest = hashlib.sha256(payload).hexdigest()
+        path = self.path(digest)
+        if not os.path.exists(path):
+            temp = f"{path}.{os.getpid()}.tmp"
+            with open(temp, 'wb') as file:
+                file.write(payload)
+            os.replace(temp, path)
+        entry = (content_type, digest, int(time.time()))
+        self.entries[name] = entry
+        self.append(name, entry)
+        return Emote(name, content_type, digest=digest, source=self)
+
+    def remove(self, name):
+        """Forget the emote of the given name.
+
+        The payload stays on disk, as other emotes may share it.
+        """
+        if name in self.entries:
+            del self.entries[name]
+            self.append(name, (None, None, None))
+
+    def emote(self, name):
+        (content_type, digest, _) = self.entries[name]
+        return Emote(name, content_type, digest=digest, source=self)
+
+    def emotes(self):
+        """Returns a list of all stored emotes."""
+        return [self.emote(name) for name in self.entries]
+
+    def is_stale(self, name):
+        """Returns true if the emote is unknown or was last received more than max_age seconds ago."""
+        entry = self.entries.get(name, None)
+        if entry is None:
+            return True
+        return self.max_age is not None and self.max_age < time.time() - entry[2]
+
+    def read(self, digest):
+        """Returns the payload for the digest, reading it from disk if it is not cached."""
+        payload = self.cache.get(digest, None)
+        if payload is not None:
+            self.cache.move_to_end(digest)
+            return payload
+        with open(self.path(digest), 'rb') as file:
+            payload = file.read()
+        if len(payload) <= self.memory_limit:
+            self.cache[digest] = payload
+            self.cached = self.cached + len(payload)
+            while self.memory_limit < self.cached:
+                (_, evicted) = self.cache.popitem(last=False)
+                self.cached = self.cached - len(evicted)
+        return payload
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,121 @@
+from . import update
+from . import wire
+from .payload import PayloadFile, PayloadSink
+import copy
+import sqlite3
+import time
+
+class HistoryStore:
+    """A local record of the updates distributed to channels, kept in SQLite.
+
+    The database is opened in WAL mode, so that readers do not block
+    the client writing to it. Updates are stored with their channel,
+    sender, ID, clock, and wire representation, and duplicates by
+    sender and ID are dropped, so backfill may safely overlap with
+    what is already stored.
+
+    Payloads that were streamed to or from a file are not kept, and
+    are stored as NIL instead.
+
+    The connection may be used from any thread, but writes must not
+    happen concurrently. The client only records from handle.
+
+    The last clock seen in each channel is remembered, so that only
+    newer updates need to be requested with backfill's since field.
+
+    Writes are committed in batches of commit_size updates, or once
+    commit_interval seconds have passed since the last commit. Call
+    commit or close to write out the rest.
+    """
+    __slots__ = 'connection', 'pending', 'committed', 'commit_size', 'commit_interval', 'ignored'
+
+    def __init__(self, path, commit_size=256, commit_interval=1.0):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS updates (
+            channel TEXT NOT NULL,
+            sender TEXT NOT NULL,
+            id INTEGER NOT NULL,
+            clock INTEGER NOT NULL,
+            type TEXT NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (sender, id))""")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS updates_channel_clock ON updates (channel, clock)")
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS channels (
+            name TEXT PRIMARY KEY,
+            clock INTEGER NOT NULL)""")
+        self.connection.commit()
+        self.pending = 0
+        self.committed = time.monotonic()
+        self.commit_size = commit_size
+        self.commit_interval = commit_interval
+        # Requests and their replies are not part of a channel's history.
+        self.ignored = (update.Backfill, update.Search, update.Users, update.ChannelInfo, update.Emotes)
+
+    def record(self, instance):
+        """Store the channel update. Returns true if it was not stored already."""
+        if not isinstance(instance, update.ChannelUpdate) or isinstance(instance, self.ignored):
+            return False
+        if instance.channel is None or instance.id is None or instance.clock is None:
+            return False
+        channel = instance.channel.casefold()
+        cursor = self.connection.execute(
+            "INSERT OR IGNORE INTO updates (channel, sender, id, clock, type, data) VALUES (?, ?, ?, ?, ?, ?)",
+            (channel, (instance['from'] or '').casefold(), instance.id, instance.clock,
+             instance.__class__.__name__, wire.to_string(storable(instance).to_list())))
+        if cursor.rowcount == 0:
+            return False
+        self.connection.execute(
+            "INSERT INTO channels (name, clock) VALUES (?, ?) ON CONFLICT (name) DO UPDATE SET clock = max(clock, excluded.clock)",
+            (channel, instance.clock))
+        self.pending = self.pending + 1
+        if self.commit_size <= self.pending or self.commit_interval <= time.monotonic() - self.committed:
+            self.commit()
+        return True
+
+    def commit(self):
+        self.connection.commit()
+        self.pending = 0
+        self.committed = time.monotonic()
+
+    def since(self, channel):
+        """Returns the last clock seen in the channel, or None."""
+        row = self.connection.execute("SELECT clock FROM channels WHERE name = ?", (channel.casefold(),)).fetchone()
+        return row[0] if row else None
+
+    def channels(self):
+        """Returns the names of the channels with a recorded history."""
+        return [row[0] for row in self.connection.execute("SELECT name FROM channels ORDER BY name")]
+
+    def updates(self, channel, since=None, limit=None):
+        """Returns the stored updates of the channel in order of their clock.
+
+        If since is given, only updates from that clock on are
+        returned. If limit is given, only the latest that many
+        updates are returned.
+        """
+        query = "SELECT data FROM updates WHERE channel = ? AND clock >= ? ORDER BY clock DESC, rowid DESC"
+        args = (channel.casefold(), since or 0)
+        if limit is not None:
+            query = query + " LIMIT ?"
+            args = args + (limit,)
+        instances = []
+        for (data,) in self.connection.execute(query, args):
+            value = wire.from_string(data)[0]
+            instance = update.make_instance_plist(value[0], value[1:])
+            if instance is not None:
+                instances.append(instance)
+        instances.reverse()
+        return instances
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+def storable(instance):
+    # Streamed payloads live in files and cannot be written out as text.
+    if 'payload' in instance.__slotmap__ and isinstance(instance.payload, (PayloadFile, PayloadSink)):
+        instance = copy.copy(instance)
+        instance.payload = None
+    return instance
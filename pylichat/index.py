@@ -0,0 +1,243 @@
+from . import update
+from .symbol import Symbol, li
+import collections
+import functools
+import re
+
+any_time = li('t')
+
+@functools.lru_cache(maxsize=1024)
+def compile_match(spec):
+    """Returns a regular expression and the literal runs for the matching spec.
+
+    In the spec, _ matches any one character, * matches any number
+    of characters, and a backslash escapes the character after it.
+    The spec should already be casefolded.
+
+    See shirakumo-history
+    """
+    parts = []
+    literals = []
+    literal = ''
+    i = 0
+    while i < len(spec):
+        char = spec[i]
+        if char == '\\' and i+1 < len(spec):
+            i = i+1
+            literal = literal + spec[i]
+        elif char == '_' or char == '*':
+            if literal:
+                parts.append(re.escape(literal))
+                literals.append(literal)
+                literal = ''
+            parts.append('.' if char == '_' else '.*')
+        else:
+            literal = literal + char
+        i = i+1
+    if literal:
+        parts.append(re.escape(literal))
+        literals.append(literal)
+    return (re.compile(''.join(parts), re.DOTALL), literals)
+
+def trigrams(text):
+    return {text[i:i+3] for i in range(len(text)-2)}
+
+def query_items(query):
+    """Returns the query as a list of field name and value pairs."""
+    if isinstance(query, dict):
+        pairs = query.items()
+    else:
+        pairs = zip(query[0::2], query[1::2])
+    return [(key.name if isinstance(key, Symbol) else key, value) for (key, value) in pairs]
+
+def match_specs(specs):
+    if isinstance(specs, str):
+        specs = [specs]
+    return [compile_match(spec.casefold()) for spec in specs]
+
+def match_value(query, value):
+    """Returns true if the field value matches the query value.
+
+    Follows the rules of the search update: strings are matched
+    against a list of matching specs, numbers compared for
+    equality or against a range of two bounds where T is any,
+    symbols by identity, and lists must contain every element
+    of the query list.
+
+    See shirakumo-history
+    """
+    if isinstance(value, str):
+        value = value.casefold()
+        return any(rx.fullmatch(value) for (rx, _) in match_specs(query))
+    if isinstance(value, (int, float)):
+        if isinstance(query, list):
+            if len(query) != 2:
+                return False
+            (low, high) = query
+            return ((low is any_time or low is True or low <= value)
+                    and (high is any_time or high is True or value <= high))
+        return query == value
+    if isinstance(value, list):
+        if not isinstance(query, list):
+            return False
+        return all(any(match_value(q, v) for v in value) for q in query)
+    return query is value or query == value
+
+class MessageIndex:
+    """An inverted index over messages to search them locally.
+
+    Messages are indexed by their channel, their sender, and the
+    trigrams of their text, so that queries can be answered
+    without a round trip to the server, even while disconnected.
+    Queries have the same shape as the query field of a Search
+    update: a list of alternating field symbols and values, such
+    as [kw('from'), "tester", kw('clock'), [3786825600, li('t')],
+    kw('text'), ["this", "that is"]]. A dict of field names to
+    values works as well.
+
+    Unlike on the server, text specs match anywhere in the text,
+    while other string fields such as from and channel must match
+    as a whole. All matching is case-insensitive.
+
+    Duplicates by sender and ID are ignored. If limit is set, the
+    oldest indexed messages are dropped once more than that many
+    are held.
+
+    Attach an instance to a client's index field to index all
+    received messages, and fill it from a HistoryStore with
+    extend to search older messages as well.
+    """
+    __slots__ = 'messages', 'keys', 'order', 'channels', 'senders', 'trigrams', 'limit', 'next'
+
+    def __init__(self, limit=None):
+        self.messages = {}
+        self.keys = {}
+        self.order = collections.deque()
+        self.channels = {}
+        self.senders = {}
+        self.trigrams = {}
+        self.limit = limit
+        self.next = 0
+
+    def add(self, instance):
+        """Index the message. Returns true if it was not indexed already."""
+        if not isinstance(instance, update.Message) or not isinstance(instance.text, str):
+            return False
+        key = ((instance['from'] or '').casefold(), instance.id)
+        if key in self.keys:
+            return False
+        doc = self.next
+        self.next = doc+1
+        text = instance.text.casefold()
+        self.messages[doc] = (instance, text)
+        self.keys[key] = doc
+        self.order.append(doc)
+        self.channels.setdefault((instance.channel or '').casefold(), set()).add(doc)
+        self.senders.setdefault(key[0], set()).add(doc)
+        for trigram in trigrams(text):
+            self.trigrams.setdefault(trigram, set()).add(doc)
+        if self.limit is not None:
+            while self.limit < len(self.order):
+                self.remove(self.order.popleft())
+        return True
+
+    def extend(self, instances):
+        """Index all messages among the updates."""
+        for instance in instances:
+            self.add(instance)
+
+    def remove(self, doc):
+        (instance, text) = self.messages.pop(doc)
+        sender = (instance['from'] or '').casefold()
+        del self.keys[(sender, instance.id)]
+        discard(self.channels, (instance.channel or '').casefold(), doc)
+        discard(self.senders, sender, doc)
+        for trigram in trigrams(text):
+            discard(self.trigrams, trigram, doc)
+
+    def names(self, table, specs):
+        docs = set()
+        for (rx, literals) in match_specs(specs):
+            if rx.pattern == re.escape(''.join(literals)):
+                docs.update(table.get(''.join(literals), ()))
+            else:
+                for (name, found) in table.items():
+                    if rx.fullmatch(name):
+                        docs.update(found)
+        return docs
+
+    def texts(self, specs):
+        docs = set()
+        for (_, literals) in match_specs(specs):
+            grams = set()
+            for literal in literals:
+                grams.update(trigrams(literal))
+            if not grams:
+                # Too short to narrow down, every message is a candidate.
+                return None
+            found = None
+            for gram in sorted(grams, key=lambda gram: len(self.trigrams.get(gram, ()))):
+                posting = self.trigrams.get(gram, ())
+                found = set(posting) if found is None else found.intersection(posting)
+                if not found:
+                    break
+            docs.update(found)
+        return docs
+
+    def candidates(self, items, channel=None):
+        sets = []
+        if channel is not None:
+            sets.append(self.channels.get(channel.casefold(), set()))
+        for (name, value) in items:
+            if name == 'channel':
+                sets.append(self.names(self.channels, value))
+            elif name == 'from':
+                sets.append(self.names(self.senders, value))
+            elif name == 'text':
+                docs = self.texts(value)
+                if docs is not None:
+                    sets.append(docs)
+        if not sets:
+            return self.messages.keys()
+        sets.sort(key=len)
+        return sets[0].intersection(*sets[1:])
+
+    def matches(self, doc, items):
+        (instance, text) = self.messages[doc]
+        for (name, value) in items:
+            if name == 'text':
+                if not any(rx.search(text) for (rx, _) in match_specs(value)):
+                    return False
+            else:
+                try:
+                    field = instance[name]
+                except KeyError:
+                    return False
+                if field is None or not match_value(value, field):
+                    return False
+        return True
+
+    def search(self, query, channel=None, offset=0, limit=None):
+        """Returns the messages matching the query, the most recent first.
+
+        If channel is given, only messages in that channel are
+        searched. The first offset results are skipped, and at
+        most limit results are returned.
+
+        See MessageIndex
+        """
+        items = query_items(query)
+        docs = [doc for doc in self.candidates(items, channel) if self.matches(doc, items)]
+        docs.sort(key=lambda doc: (self.messages[doc][0].clock or 0, doc), reverse=True)
+        end = None if limit is None else offset+limit
+        return [self.messages[doc][0] for doc in docs[offset:end]]
+
+    def __len__(self):
+        return len(self.messages)
+
+def discard(table, key, doc):
+    docs = table.get(key, None)
+    if docs is not None:
+        docs.discard(doc)
+        if not docs:
+            del table[key]
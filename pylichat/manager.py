@@ -0,0 +1,108 @@
+from .client import ConnectionLost
+import selectors
+
+class ClientManager:
+    """Drives many connected Clients from a single thread.
+
+    Instead of every client polling its own socket, the sockets
+    of all added clients are registered with one selector (epoll
+    on Linux, kqueue on BSD), so a single system call covers the
+    whole set and there is no limit on file descriptor numbers.
+
+    Clients should be connected before they are added. Added
+    clients are switched to buffered sending, and their queued
+    updates are written out whenever their socket is writable.
+    Updates held back by a client's rate limiter are released
+    at the start of each poll.
+    Once a client disconnects, it is removed from the manager
+    automatically.
+    """
+    __slots__ = 'selector', 'clients', 'events'
+
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.clients = {}
+        self.events = {}
+
+    def add(self, client):
+        """Start dispatching updates for the given connected client."""
+        if client.socket is None:
+            raise ValueError("Client is not connected.")
+        client.buffered = True
+        self.clients[client] = client.socket
+        self.events[client] = selectors.EVENT_READ
+        self.selector.register(client.socket, selectors.EVENT_READ, client)
+        return client
+
+    def remove(self, client):
+        """Stop dispatching updates for the given client."""
+        socket = self.clients.pop(client, None)
+        self.events.pop(client, None)
+        if socket is not None:
+            self.selector.unregister(socket)
+        return client
+
+    def poll(self, timeout=None):
+        """Wait for any client to become ready and process it.
+
+        Every update read from a ready client is handled through
+        the client's handle function. Returns the number of
+        updates that were handled.
+        """
+        count = 0
+        for client in list(self.clients):
+            if client.socket is not self.clients[client]:
+                self.remove(client)
+                continue
+            try:
+                delay = client.release_queued()
+            except ConnectionLost:
+                self.remove(client)
+                continue
+            if delay is not None and (timeout is None or delay < timeout):
+                timeout = delay
+            self.watch(client)
+        for (key, mask) in self.selector.select(timeout):
+            client = key.data
+            if mask & selectors.EVENT_WRITE and client.socket is not None:
+                self.flush(client)
+            if mask & selectors.EVENT_READ and client.socket is not None:
+                for instance in client.recv_ready():
+                    client.handle(instance)
+                    count = count+1
+            if client.socket is not None and client.pending_output():
+                self.flush(client)
+            if client.socket is not self.clients.get(client):
+                self.remove(client)
+        return count
+
+    def flush(self, client):
+        try:
+            client.flush()
+        except ConnectionLost:
+            pass
+
+    def watch(self, client):
+        events = selectors.EVENT_READ
+        if client.pending_output():
+            events = events | selectors.EVENT_WRITE
+        if events != self.events[client]:
+            self.events[client] = events
+            self.selector.modify(client.socket, events, client)
+
+    def loop(self):
+        """Process clients until all of them have disconnected."""
+        while self.clients:
+            self.poll(1.0)
+
+    def close(self):
+        """Remove all clients and release the selector."""
+        for client in list(self.clients):
+            self.remove(client)
+        self.selector.close()
+
+    def __len__(self):
+        return len(self.clients)
+
+    def __iter__(self):
+        return iter(self.clients)
@@ -0,0 +1,130 @@
+import bisect
+import time
+
+class Histogram:
+    """A histogram of durations in seconds, with buckets growing in powers of two.
+
+    The smallest bucket holds durations up to one microsecond, the
+    largest up to about 17 seconds, and anything longer is counted
+    in a final overflow bucket.
+    """
+    __slots__ = 'bounds', 'counts', 'count', 'total', 'min', 'max'
+
+    def __init__(self, smallest=0.000001, buckets=25):
+        self.bounds = [smallest * 2**i for i in range(buckets)]
+        self.counts = [0] * (buckets+1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value, count=1):
+        self.counts[bisect.bisect_left(self.bounds, value)] += count
+        self.count = self.count + count
+        self.total = self.total + value*count
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or self.max < value:
+            self.max = value
+
+    def quantile(self, q):
+        """Returns the upper bound of the bucket the q-quantile falls into."""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for (i, count) in enumerate(self.counts):
+            seen = seen + count
+            if rank <= seen and 0 < count:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.total / self.count if self.count else None,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'buckets': {(f"{self.bounds[i]:g}" if i < len(self.bounds) else 'inf'): count
+                        for (i, count) in enumerate(self.counts) if count}
+        }
+
+class Metrics:
+    """Counters and timings of the traffic of a Client.
+
+    Counts the bytes and frames sent and received, and the updates
+    sent and received per class. Keeps histograms of the time spent
+    parsing received data per frame, of the time spent serialising
+    each sent update, and of the latency between sending an update
+    and handling the response to it, as matched by ID.
+
+    Attach an instance to a client's metrics field to enable it,
+    and read it with the client's stats function.
+    """
+    __slots__ = ('bytes_sent', 'bytes_received', 'frames_sent', 'frames_received',
+                 'updates_sent', 'updates_received', 'parse', 'serialize', 'latency',
+                 'pending', 'started')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.frames_sent = 0
+        self.frames_received = 0
+        self.updates_sent = {}
+        self.updates_received = {}
+        self.parse = Histogram()
+        self.serialize = Histogram()
+        self.latency = Histogram()
+        self.pending = {}
+        self.started = time.monotonic()
+
+    def sent(self, instance, size):
+        name = instance.__class__.__name__
+        self.updates_sent[name] = self.updates_sent.get(name, 0) + 1
+        self.pending[instance.id] = time.monotonic()
+        self.sent_raw(size)
+
+    def sent_raw(self, size):
+        self.bytes_sent = self.bytes_sent + size
+        self.frames_sent = self.frames_sent + 1
+
+    def received(self, size, frames, elapsed):
+        self.bytes_received = self.bytes_received + size
+        if frames:
+            self.frames_received = self.frames_received + frames
+            self.parse.add(elapsed / frames, frames)
+
+    def received_update(self, instance):
+        name = instance.__class__.__name__
+        self.updates_received[name] = self.updates_received.get(name, 0) + 1
+
+    def responded(self, id):
+        sent = self.pending.pop(id, None)
+        if sent is not None:
+            self.latency.add(time.monotonic() - sent)
+
+    def expired(self, id):
+        self.pending.pop(id, None)
+
+    def snapshot(self):
+        """Returns the current values as a dictionary of plain values."""
+        return {
+            'uptime': time.monotonic() - self.started,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'frames_sent': self.frames_sent,
+            'frames_received': self.frames_received,
+            'updates_sent': dict(self.updates_sent),
+            'updates_received': dict(self.updates_received),
+            'awaiting_response': len(self.pending),
+            'parse_time': self.parse.snapshot(),
+            'serialize_time': self.serialize.snapshot(),
+            'latency': self.latency.snapshot()
+        }
@@ -0,0 +1,110 @@
+from . import wire
+from .symbol import kw
+import base64
+import binascii
+
+class PayloadFile:
+    """A file on disk to send as the base64 payload of an update.
+
+    The file is read and encoded in chunks of chunk_size bytes
+    while the update is written out, so it is never held in
+    memory as a whole.
+    """
+    __slots__ = 'path', 'chunk_size'
+
+    def __init__(self, path, chunk_size=3*16384):
+        self.path = path
+        self.chunk_size = chunk_size
+
+    def __repr__(self):
+        return f"<PayloadFile {self.path}>"
+
+class PayloadSink:
+    """Decodes a base64 payload into a binary file as it is received.
+
+    The file is not closed once the payload is complete. The sink
+    takes the place of the payload string in the received update,
+    and holds the file and the number of bytes written to it.
+
+    If the payload is not valid base64, the rest of it is skipped
+    and error holds the exception, so that the update can be
+    dropped without losing the connection.
+    """
+    __slots__ = 'file', 'size', 'rest', 'error'
+
+    def __init__(self, file):
+        self.file = file
+        self.size = 0
+        self.rest = ''
+        self.error = None
+
+    def write(self, text):
+        if self.error is not None:
+            return
+        text = self.rest + text
+        cut = len(text) - len(text) % 4
+        self.rest = text[cut:]
+        if 0 < cut:
+            self.decode(text[:cut])
+
+    def decode(self, text):
+        try:
+            data = base64.b64decode(text)
+        except binascii.Error as e:
+            self.error = e
+            self.rest = ''
+            return
+        self.file.write(data)
+        self.size = self.size + len(data)
+
+    def close(self):
+        if self.rest and self.error is None:
+            self.decode(self.rest)
+            self.rest = ''
+        return self
+
+    def __repr__(self):
+        return f"<PayloadSink {self.size} bytes>"
+
+def write_streamed(instance, buffer):
+    """Write the update, whose payload is a PayloadFile, to the buffer in pieces.
+
+    This is a generator that yields the number of bytes written so
+    far after each piece, at which point the caller may send out
+    and empty the buffer. The frame is terminated with a NUL. The
+    file is opened before anything is written, so that a missing
+    file leaves the buffer untouched.
+    """
+    items = instance.to_list()
+    key = kw('payload')
+    for i in range(1, len(items), 2):
+        if items[i] == key:
+            source = items[i+1]
+            del items[i:i+2]
+            break
+    with open(source.path, 'rb') as file:
+        start = len(buffer)
+        wire.write_bytes(items, buffer)
+        buffer[-1:] = b' :payload "'
+        size = len(buffer) - start
+        yield size
+        rest = b''
+        while True:
+            chunk = file.read(source.chunk_size)
+            if not chunk:
+                break
+            chunk = rest + chunk
+            cut = len(chunk) - len(chunk) % 3
+            rest = chunk[cut:]
+            encoded = base64.b64encode(chunk[:cut])
+            buffer += encoded
+            size = size + len(encoded)
+            yield size
+        encoded = base64.b64encode(rest)
+        buffer += encoded
+        buffer += b'")\0'
+        yield size + len(encoded) + 3
+
+def is_streamed(instance):
+    """Returns true if the update has a PayloadFile as its payload."""
+    return 'payload' in instance.__slotmap__ and type(instance.payload) is PayloadFile
@@ -0,0 +1,168 @@
+from . import update
+import collections
+import time
+
+class TokenBucket:
+    """A token bucket refilling at rate tokens per second up to burst tokens."""
+    __slots__ = 'rate', 'burst', 'tokens', 'stamp'
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self, now):
+        """Returns the number of seconds until a token is available."""
+        self.refill(now)
+        if 1 <= self.tokens:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens = self.tokens - 1
+
+class RateLimiter:
+    """Paces the updates a client sends.
+
+    All updates except for the connection control updates draw
+    from a global bucket of rate updates per second, with bursts
+    of up to burst updates. Messages additionally draw from a
+    bucket per channel of channel_rate messages per second, if
+    set.
+
+    When a channel is paused by the server with a Pause update,
+    its bucket is limited to one message every 'by' seconds. When
+    the server reports that it is being flooded, the global rate
+    is halved, and then recovers linearly to the configured rate
+    over recovery seconds.
+
+    Updates that can't be sent yet are queued, in order per
+    channel, and released once their buckets allow it. Nothing is
+    ever dropped.
+    """
+    __slots__ = ('rate', 'burst', 'channel_rate', 'channel_burst', 'min_rate', 'recovery',
+                 'bucket', 'channels', 'paused', 'queues')
+
+    exempt = (update.Ping, update.Pong, update.Connect, update.Disconnect)
+
+    def __init__(self, rate=10.0, burst=20, channel_rate=None, channel_burst=5, min_rate=0.5, recovery=60.0):
+        self.rate = rate
+        self.burst = burst
+        self.channel_rate = channel_rate
+        self.channel_burst = channel_burst
+        self.min_rate = min_rate
+        self.recovery = recovery
+        self.bucket = TokenBucket(rate, burst)
+        self.channels = {}
+        self.paused = {}
+        self.queues = {}
+
+    def key(self, instance):
+        if isinstance(instance, update.Message) and instance.channel is not None:
+            return instance.channel.casefold()
+        return None
+
+    def channel_bucket(self, key):
+        bucket = self.channels.get(key, None)
+        if bucket is None:
+            by = self.paused.get(key, None)
+            if by is not None:
+                bucket = TokenBucket(1.0 / by, 1)
+            elif self.channel_rate is not None:
+                bucket = TokenBucket(self.channel_rate, self.channel_burst)
+            else:
+                return None
+            self.channels[key] = bucket
+        return bucket
+
+    def delay(self, key, now):
+        bucket = self.bucket
+        if bucket.rate < self.rate:
+            bucket.rate = min(self.rate, bucket.rate + (now - bucket.stamp) * self.rate / self.recovery)
+        delay = bucket.delay(now)
+        if key is not None:
+            channel = self.channel_bucket(key)
+            if channel is not None:
+                delay = max(delay, channel.delay(now))
+        return delay
+
+    def take(self, key):
+        self.bucket.take()
+        if key is not None:
+            channel = self.channel_bucket(key)
+            if channel is not None:
+                channel.take()
+
+    def admit(self, instance):
+        """Returns true and uses up tokens if the update may be sent right away.
+
+        If false is returned, the update has to be enqueued.
+        """
+        if isinstance(instance, RateLimiter.exempt):
+            return True
+        key = self.key(instance)
+        if self.queues.get(key) or 0 < self.delay(key, time.monotonic()):
+            return False
+        self.take(key)
+        return True
+
+    def enqueue(self, instance, callback=None):
+        key = self.key(instance)
+        queue = self.queues.get(key, None)
+        if queue is None:
+            queue = self.queues[key] = collections.deque()
+        queue.append((instance, callback))
+
+    def release(self):
+        """Returns the list of queued updates and callbacks that may be sent now."""
+        released = []
+        now = time.monotonic()
+        progress = True
+        while progress and self.queues:
+            progress = False
+            for key in list(self.queues):
+                if self.delay(key, now) <= 0:
+                    queue = self.queues[key]
+                    released.append(queue.popleft())
+                    self.take(key)
+                    progress = True
+                    if not queue:
+                        del self.queues[key]
+        return released
+
+    def next_delay(self):
+        """Returns the seconds until the next queued update can be sent, or None."""
+        if not self.queues:
+            return None
+        now = time.monotonic()
+        return min(self.delay(key, now) for key in self.queues)
+
+    def depth(self, channel=None):
+        """Returns the number of queued updates, overall or for the given channel."""
+        if channel is not None:
+            return len(self.queues.get(channel.casefold(), ()))
+        return sum(len(queue) for queue in self.queues.values())
+
+    def pause(self, channel, by):
+        """Limit the channel to one message every by seconds, or lift the limit if by is zero."""
+        key = channel.casefold()
+        if by:
+            self.paused[key] = by
+        else:
+            self.paused.pop(key, None)
+        self.channels.pop(key, None)
+
+    def throttle(self):
+        """Halve the global rate after the server reported being flooded."""
+        self.bucket.refill(time.monotonic())
+        self.bucket.rate = max(self.min_rate, self.bucket.rate / 2)
+        self.bucket.tokens = min(self.bucket.tokens, 0)
+
+    def clear(self):
+        """Drop all queued updates."""
+        self.queues.clear()
@@ -1,5 +1,32 @@
+import operator
+
 package_table={}
 
+class Symbol(tuple):
+    """A symbol, consisting of a package name and a symbol name.
+
+    Symbols are interned in their package, so there is only ever
+    one symbol for a package and name, and they are compared by
+    identity. For compatibility with code that expects symbols to
+    be (package, name) tuples, they are tuples of the two as well,
+    so they compare equal to and hash like the matching tuple.
+    """
+    __slots__ = ()
+
+    def __new__(cls, package, name):
+        return tuple.__new__(cls, (package, name))
+
+    package = property(operator.itemgetter(0))
+    name = property(operator.itemgetter(1))
+
+    def __reduce__(self):
+        return (intern, (self.name, self.package))
+
+    def __repr__(self):
+        if self.package == 'keyword':
+            return f"<Symbol :{self.name}>"
+        return f"<Symbol {self.package}:{self.name}>"
+
 def find_package(name):
     return package_table.get(name.lower(), None)
 
@@ -12,7 +39,7 @@ def make_package(name, symbols=[]):
     for symbol in symbols:
         symbol = symbol.lower()
         if index.get(symbol, None) == None:
-            index[symbol] = (name, symbol)
+            index[symbol] = Symbol(name, symbol)
     return index
 
 def delete_package(name):
@@ -25,15 +52,21 @@ def find_symbol(name, package='lichat'):
     return index.get(name.lower(), None)
 
 def intern(name, package='lichat'):
-    name = name.lower()
-    package = package.lower()
-    index = find_package(package)
-    if index == None:
-        return None
+    # Names and packages are usually lowercase already, so try them
+    # as they are before lowercasing.
+    index = package_table.get(package, None)
+    if index is None:
+        package = package.lower()
+        index = package_table.get(package, None)
+        if index is None:
+            return None
     existing = index.get(name, None)
-    if existing == None:
-        existing = (package, name)
-        index[name] = existing
+    if existing is None:
+        name = name.lower()
+        existing = index.get(name, None)
+        if existing is None:
+            existing = Symbol(package, name)
+            index[name] = existing
     return existing
 
 def unintern(symbol):
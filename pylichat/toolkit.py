@@ -1,4 +1,5 @@
 import collections.abc
+import threading
 
 class CaseInsensitiveDict(collections.abc.MutableMapping):
     """A dict where key lookup ignores case (Unicode case-folding as per str.casefold())"""
@@ -52,3 +53,140 @@ class CaseInsensitiveSet(collections.abc.MutableSet):
 
     def __repr__(self):
         return f"CaseInsensitiveSet({set(self)})"
+
+class UserRegistry:
+    """Interns user names as small integer IDs, ignoring case.
+
+    Every name is stored once, no matter how many sets it is a
+    member of. Entries are reference counted by the UserSets
+    holding them, and their IDs are reused once no set holds
+    them anymore.
+
+    The registry and the sets using it may be used from several
+    threads, their changes are done under the registry's lock.
+    """
+    __slots__ = 'ids', 'names', 'counts', 'free', 'lock'
+
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+        self.counts = []
+        self.free = []
+        # Reentrant, as sets may be collected while the lock is held.
+        self.lock = threading.RLock()
+
+    def find(self, name):
+        """Returns the ID of the name, or None if it is not interned."""
+        return self.ids.get(name.casefold(), None)
+
+    def intern(self, name):
+        """Returns the ID of the name, interning it if necessary."""
+        key = name.casefold()
+        with self.lock:
+            id = self.ids.get(key, None)
+            if id is None:
+                if key == name:
+                    key = name
+                if self.free:
+                    id = self.free.pop()
+                    self.names[id] = name
+                else:
+                    id = len(self.names)
+                    self.names.append(name)
+                    self.counts.append(0)
+                self.ids[key] = id
+            return id
+
+    def name(self, id):
+        return self.names[id]
+
+    def retain(self, id):
+        with self.lock:
+            self.counts[id] = self.counts[id] + 1
+
+    def release(self, id):
+        with self.lock:
+            count = self.counts[id] - 1
+            self.counts[id] = count
+            if count <= 0:
+                del self.ids[self.names[id].casefold()]
+                self.names[id] = None
+                self.free.append(id)
+
+    def __len__(self):
+        return len(self.ids)
+
+class UserSet(collections.abc.MutableSet):
+    """A set of user names, ignoring case, stored as IDs in a UserRegistry."""
+    __slots__ = 'registry', 'ids'
+
+    def __init__(self, registry, s=()):
+        self.registry = registry
+        self.ids = set()
+        for i in s:
+            self.add(i)
+
+    def __contains__(self, i):
+        id = self.registry.find(i)
+        return id is not None and id in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        registry = self.registry
+        with registry.lock:
+            return iter([registry.names[id] for id in self.ids])
+
+    def add(self, i):
+        registry = self.registry
+        with registry.lock:
+            id = registry.intern(i)
+            if id not in self.ids:
+                self.ids.add(id)
+                registry.retain(id)
+
+    def discard(self, i):
+        registry = self.registry
+        with registry.lock:
+            id = registry.find(i)
+            if id is not None and id in self.ids:
+                self.ids.remove(id)
+                registry.release(id)
+
+    def clear(self):
+        registry = self.registry
+        with registry.lock:
+            (ids, self.ids) = (self.ids, set())
+            for id in ids:
+                registry.release(id)
+
+    def sync(self, names):
+        """Make the set contain exactly the given names.
+
+        Returns a tuple of the list of names that were added and
+        the list of names that were removed.
+        """
+        registry = self.registry
+        intern = registry.intern
+        with registry.lock:
+            ids = {intern(name) for name in names}
+            joined = ids - self.ids
+            left = self.ids - ids
+            for id in joined:
+                registry.retain(id)
+            joined = [registry.names[id] for id in joined]
+            left_names = [registry.names[id] for id in left]
+            self.ids = ids
+            for id in left:
+                registry.release(id)
+        return (joined, left_names)
+
+    def __del__(self):
+        try:
+            self.clear()
+        except Exception:
+            pass
+
+    def __repr__(self):
+        return f"UserSet({set(self)})"
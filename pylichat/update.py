@@ -1,23 +1,45 @@
-from .symbol import kw,li,make_package
+from .symbol import Symbol,kw,li,make_package,intern
 from .wire import from_string,to_string
 import os
+import keyword
 import textwrap
 import collections.abc
-import inspect
+import zlib
+import json
 
 version = '2.0'
 extensions = set()
 class_registry = {}
+lazy_classes = {}
+lazy_names = {}
+spec_cache_version = 2
 
 class LichatObject(collections.abc.MutableMapping):
+    __slots__ = ()
+    __fields__ = ()
+    __slotmap__ = {}
+    __defaults__ = {}
+    __supers__ = ()
+
     def __init__(self, **kwargs):
         if len(kwargs) > 0:
-            raise ValueError(f"Unexpected field(s) reached LichatObject constructor; lichat class {to_string(self.__class__.__symbol__)!r} doesn't have field(s) {list(kwargs.keys())}.")
+            unexpected_fields(self, kwargs)
+
+    @classmethod
+    def from_plist(cls, initargs):
+        kwargs = {}
+        for k,v in zip(*[iter(initargs)]*2):
+            if is_keyword(k):
+                kwargs[k[1].lower()] = v
+            else:
+                kwargs[k] = v
+        return cls(**kwargs)
 
     def to_list(self):
         plist = []
-        for key in self.__dict__.keys():
-            val = self.__dict__[key]
+        slotmap = self.__slotmap__
+        for key in self.__fields__:
+            val = getattr(self, slotmap[key], None)
             if val != None:
                 plist.append(kw(key))
                 plist.append(val)
@@ -26,137 +48,410 @@ class LichatObject(collections.abc.MutableMapping):
     def unix_clock(self):
         return self.clock - 2208988800
 
+    def __getattr__(self, key):
+        # Allows getattr with field names that aren't identifiers, like update-id.
+        slot = self.__slotmap__.get(key, key)
+        if slot == key:
+            raise AttributeError(f"{self.__class__.__qualname__!r} object has no attribute {key!r}")
+        return getattr(self, slot)
+
     def __getitem__(self, key):
         try:
-            return getattr(self, key)
-        except AttributeError:
+            return getattr(self, self.__slotmap__[key])
+        except (KeyError, AttributeError):
             raise KeyError(f"{key!r}")
 
     def __setitem__(self, key, value):
-        return setattr(self, key, value)
+        try:
+            slot = self.__slotmap__[key]
+        except KeyError:
+            raise KeyError(f"{key!r}")
+        return setattr(self, slot, value)
 
     def __delitem__(self, key):
-        return delattr(self, key)
+        try:
+            return delattr(self, self.__slotmap__[key])
+        except (KeyError, AttributeError):
+            raise KeyError(f"{key!r}")
 
     def __len__(self):
-        return len(self.__dict__)
+        return sum(1 for _ in self)
 
     def __iter__(self):
-        return iter(self.__dict__)
+        for key in self.__fields__:
+            if hasattr(self, self.__slotmap__[key]):
+                yield key
 
     def __repr__(self):
         return (f"{self.__class__.__qualname__}("
-                + ", ".join(f"{k}={self[k]!r}" for k in self.__dict__)
+                + ", ".join(f"{k}={self[k]!r}" for k in self)
                 + ")")
 
     def __str__(self):
         return (f"{self.__class__.__qualname__}("
-                + ", ".join(f"{k}={textwrap.shorten(str(self[k]), width=74)}" for k in self.__dict__)
+                + ", ".join(f"{k}={textwrap.shorten(str(self[k]), width=74)}" for k in self)
                 + ")")
 
+def unexpected_fields(instance, kwargs):
+    raise ValueError(f"Unexpected field(s) reached LichatObject constructor; lichat class {to_string(instance.__class__.__symbol__)!r} doesn't have field(s) {list(kwargs.keys())}.")
+
 def register_class(symbol, clazz):
     class_registry[symbol] = clazz
     return clazz
 
 def find_class(symbol):
-    return class_registry.get(symbol, None)
+    if type(symbol) is tuple:
+        # Plain (package, name) tuples are still accepted in place of symbols.
+        symbol = intern(symbol[1], symbol[0])
+    clazz = class_registry.get(symbol, None)
+    if clazz is None and symbol in lazy_classes:
+        clazz = define_spec_class(symbol)
+    return clazz
 
 def make_instance(clazz, **initargs):
-    if type(clazz) == tuple:
+    if type(clazz) is Symbol or type(clazz) is tuple:
         clazz = find_class(clazz)
     if clazz == None:
         return None
     return clazz(**initargs)
 
 def make_instance_plist(symbol, initargs):
-    kwargs = {}
-    for k,v in zip(*[iter(initargs)]*2):
-        if type(k) is tuple and k[0] == 'keyword':
-            kwargs[k[1].lower()] = v
-        else:
-            kwargs[k] = v
-    return make_instance(symbol, **kwargs)
+    clazz = symbol
+    if type(clazz) is Symbol or type(clazz) is tuple:
+        clazz = find_class(clazz)
+    if clazz == None:
+        return None
+    return clazz.from_plist(initargs)
+
+def superclasses(clazz):
+    """Returns the class and all of its superclasses, most specific first.
+
+    Unlike the __mro__ this includes the virtual superclasses of
+    update classes, and only contains LichatObject subclasses.
+    """
+    order = []
+    def visit(clazz):
+        if clazz in order or not issubclass(clazz, LichatObject) or clazz is LichatObject:
+            return
+        for parent in reversed(clazz.__bases__ + clazz.__supers__):
+            visit(parent)
+        order.append(clazz)
+    visit(clazz)
+    order.reverse()
+    return order
+
+def is_keyword(thing):
+    # Plain (package, name) tuples are still accepted in place of symbols.
+    return (type(thing) is Symbol or type(thing) is tuple) and thing[0] == 'keyword'
 
 def to_camelcase(name):
     return ''.join(x.title() for x in name.split('-'))
 
+def apply_fields(instance, plist):
+    kwargs = {}
+    for (key, value) in plist:
+        if is_keyword(key):
+            key = key[1].lower()
+        slot = instance.__slotmap__.get(key, None)
+        if slot is None:
+            kwargs[key] = value
+        elif value is None or value is li('nil'):
+            setattr(instance, slot, instance.__defaults__[key])
+        else:
+            setattr(instance, slot, value)
+    if kwargs:
+        unexpected_fields(instance, kwargs)
+
+def compile_class(clazz):
+    """Generate the constructor, from_plist, and to_list functions of a class.
+
+    The functions are compiled once from straight-line code for the
+    fields of the class, with the keyword symbols precomputed.
+    """
+    fields = clazz.__fields__
+    namespace = {
+        'NIL': li('nil'),
+        'SYMBOL': clazz.__symbol__,
+        'unexpected_fields': unexpected_fields,
+        'apply_fields': apply_fields,
+        'generic_to_list': LichatObject.to_list
+    }
+    def load(i):
+        slot = clazz.__slotmap__[fields[i]]
+        if keyword.iskeyword(slot):
+            namespace[f"get{i}"] = getattr(clazz, slot).__get__
+            return f"get{i}(self)"
+        return f"self.{slot}"
+    def store(i, value):
+        slot = clazz.__slotmap__[fields[i]]
+        if keyword.iskeyword(slot):
+            namespace[f"set{i}"] = getattr(clazz, slot).__set__
+            return f"set{i}(self, {value})"
+        return f"self.{slot} = {value}"
+    for i in range(len(fields)):
+        namespace[f"D{i}"] = clazz.__defaults__[fields[i]]
+        namespace[f"K{i}"] = kw(fields[i])
+    # Test for the fields that every update has first when decoding.
+    order = sorted(range(len(fields)), key=lambda i: fields[i] not in ('id', 'clock', 'from'))
+
+    lines = ["def __init__(self, **kwargs):",
+             "    pop = kwargs.pop"]
+    for i in range(len(fields)):
+        lines += [f"    v = pop({fields[i]!r}, None)",
+                  "    "+store(i, f"D{i} if v is None or v is NIL else v")]
+    lines += ["    if kwargs:",
+              "        unexpected_fields(self, kwargs)",
+              "",
+              "def from_plist(cls, plist):",
+              "    self = cls.__new__(cls)",
+              "    extra = None"]
+    for i in range(len(fields)):
+        lines += [f"    v{i} = None"]
+    lines += ["    it = iter(plist)",
+              "    for (key, value) in zip(it, it):"]
+    for (n, i) in enumerate(order):
+        lines += [f"        {'if' if n == 0 else 'elif'} key is K{i}:",
+                  f"            v{i} = value"]
+    lines += ["        else:" if fields else "        if True:",
+              "            if extra is None: extra = []",
+              "            extra.append((key, value))"]
+    for i in range(len(fields)):
+        lines += ["    "+store(i, f"D{i} if v{i} is None or v{i} is NIL else v{i}")]
+    lines += ["    if extra is not None:",
+              "        apply_fields(self, extra)",
+              "    return self",
+              "",
+              "def to_list(self):",
+              "    try:",
+              "        plist = [SYMBOL]"]
+    for i in range(len(fields)):
+        lines += [f"        v = {load(i)}",
+                  "        if v is not None:",
+                  f"            plist += (K{i}, v)"]
+    lines += ["        return plist",
+              "    except AttributeError:",
+              "        return generic_to_list(self)",
+              ""]
+    exec(compile("\n".join(lines), f"<lichat class {clazz.__name__}>", 'exec'), namespace)
+    clazz.__init__ = namespace['__init__']
+    clazz.from_plist = classmethod(namespace['from_plist'])
+    clazz.to_list = namespace['to_list']
+    return clazz
+
+def install_stubs(clazz):
+    """Install stand-ins for the functions generated by compile_class.
+
+    Compiling is deferred until the class is first constructed,
+    decoded, or encoded, at which point the stubs replace
+    themselves, so that classes which are never used cost nothing.
+    """
+    def __init__(self, **kwargs):
+        compile_class(clazz)
+        clazz.__init__(self, **kwargs)
+    def from_plist(cls, plist):
+        compile_class(clazz)
+        return cls.from_plist(plist)
+    def to_list(self):
+        compile_class(clazz)
+        return clazz.to_list(self)
+    clazz.__init__ = __init__
+    clazz.from_plist = classmethod(from_plist)
+    clazz.to_list = to_list
+    return clazz
+
+def to_slotname(field):
+    return field.replace('-', '_')
+
 def defclass(symbol, supers=(), fields={}):
     if type(symbol) is str:
         symbol = li(symbol)
+    elif type(symbol) is tuple:
+        symbol = intern(symbol[1], symbol[0])
     __class__ = None
 
-    nil_symbol = li('nil')
-    
-    def constructor(instance, **kwargs):
-        for field in fields:
-            if type(field) is str:
-                field = field.lower()
-            arg = kwargs.pop(field, None)
-            if arg is None or arg is nil_symbol:
-                setattr(instance, field, fields[field])
-            else:
-                setattr(instance, field, arg)
-        super().__init__(**kwargs)
-
     def map_superclass(name):
-        if inspect.isclass(name):
+        if isinstance(name, type):
             return name
         if type(name) is str:
             name = li(name)
+        elif type(name) is tuple:
+            name = intern(name[1], name[0])
         return find_class(name)
     
     supers = tuple(map(map_superclass, supers))
-                
-    name = to_camelcase(symbol[1])
-    __class__ = type(name, supers+(LichatObject, ), {
-        '__init__': constructor,
-        '__symbol__': symbol
+
+    # Only one base can carry slots, so the first superclass is the
+    # real base and stores its fields, while the fields of all other
+    # superclasses are stored by this class directly. The other
+    # superclasses are registered as virtual bases further down.
+    base = supers[0] if supers else LichatObject
+    defaults = {}
+    for superclass in reversed(supers):
+        defaults.update(superclass.__defaults__)
+    all_fields = []
+    for field in fields:
+        defaults[field.lower() if type(field) is str else field] = fields[field]
+        all_fields.append(field.lower() if type(field) is str else field)
+    for superclass in supers:
+        all_fields += [x for x in superclass.__fields__ if x not in all_fields]
+    stored = [x for x in all_fields if x not in base.__fields__]
+
+    slotmap = {field: to_slotname(field) for field in all_fields}
+    name = to_camelcase(symbol.name)
+    __class__ = type(name, (base, ), {
+        '__module__': __name__,
+        '__slots__': tuple(slotmap[x] for x in stored),
+        '__symbol__': symbol,
+        '__fields__': tuple(all_fields),
+        '__slotmap__': slotmap,
+        '__defaults__': defaults,
+        '__supers__': supers
         })
+    for superclass in supers[1:]:
+        superclass.register(__class__)
+    install_stubs(__class__)
     globals()[name] = __class__
     return register_class(symbol, __class__)
 
-def parse_spec(*files):
+def read_spec(*files):
+    """Parse the spec files into a table of packages, extensions, and classes.
+
+    The table only contains plain strings, tuples, and lists, so
+    that it can be cached and loaded again without the spec files
+    having to be parsed.
+    """
     text = ""
     for file in files:
         with open(file) as f:
             text = text + f.read()
     
+    packages = []
     classes = {}
-    def parse_expr(expr):
+    def parse_expr(expr, extension):
         if expr[0][1] == 'define-package':
-            make_package(expr[1])
+            packages.append(expr[1])
         elif expr[0][1] == 'define-object':
             classes[expr[1]] = [
-                set(expr[2]),
-                expr[3:]
+                [tuple(x) for x in expr[2]],
+                expr[3:],
+                extension
             ]
         elif expr[0][1] == 'define-object-extension':
             cls = classes[expr[1]]
-            cls[0] = cls[0].union(set(expr[2]))
+            cls[0] = cls[0] + [tuple(x) for x in expr[2] if tuple(x) not in cls[0]]
             cls[1] = cls[1] + expr[3:]
         elif expr[0][1] == 'define-extension':
-            extensions.add(expr[1])
+            extension_names.append(expr[1])
             for subexpr in expr[2:]:
-                parse_expr(subexpr)
+                parse_expr(subexpr, expr[1])
 
+    extension_names = []
     start = 0
     while start < len(text):
         (expr, end) = from_string(text, start)
         start = end
-        parse_expr(expr)
+        parse_expr(expr, None)
 
+    table = []
     for name in classes:
-        cls = classes[name]
-        slots = {}
-        for slot in cls[1]:
-            slots[slot[0][1]] = None
+        (supers, slots, extension) = classes[name]
+        fields = []
+        for slot in slots:
+            if slot[0][1] not in fields:
+                fields.append(slot[0][1])
+        table.append((tuple(name), supers, fields, extension))
+    return {
+        'packages': packages,
+        'extensions': extension_names,
+        'classes': table
+    }
 
-        supers = tuple(cls[0])
-        defclass(name, supers, slots)
+def define_spec_class(symbol):
+    (supers, fields, _) = lazy_classes.pop(symbol)
+    for superclass in supers:
+        if superclass in lazy_classes:
+            define_spec_class(superclass)
+    return defclass(symbol, supers, {field: None for field in fields})
+
+def load_spec(table):
+    """Define the packages, extensions, and classes of a spec table.
+
+    Classes that belong to an extension are only created once they
+    are first looked up, either through find_class or as an attribute
+    of this module.
+    """
+    for package in table['packages']:
+        make_package(package)
+    extensions.update(table['extensions'])
+    for (name, supers, fields, extension) in table['classes']:
+        symbol = intern(name[1], name[0])
+        lazy_classes[symbol] = ([intern(x[1], x[0]) for x in supers], fields, extension)
+        lazy_names[to_camelcase(symbol.name)] = symbol
+        # Intern the field keywords up front, so that reading them is a
+        # single lookup even for classes that are not defined yet.
+        for field in fields:
+            kw(field)
+    for symbol in [symbol for symbol in lazy_classes if lazy_classes[symbol][2] is None]:
+        if symbol in lazy_classes:
+            define_spec_class(symbol)
+
+def parse_spec(*files):
+    load_spec(read_spec(*files))
+
+def spec_cache_directory():
+    directory = os.environ.get('PYLICHAT_CACHE_DIR')
+    if directory is None:
+        directory = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'), 'pylichat')
+    return directory
+
+def read_cached_spec(*files):
+    """Like read_spec, but caches the table keyed by the hash of the files.
+
+    The cache is stored as JSON, so that loading it cannot run any
+    code, even if someone else managed to write to the cache
+    directory. If the cache cannot be read or written, the files
+    are simply parsed instead.
+    """
+    digest = 0
+    for file in files:
+        with open(file, 'rb') as f:
+            digest = zlib.crc32(f.read(), digest)
+    directory = spec_cache_directory()
+    path = os.path.join(directory, f"spec-{spec_cache_version}-{digest:08x}.json")
+    try:
+        with open(path) as f:
+            table = json.load(f)
+        if isinstance(table, dict) and set(table) == {'packages', 'extensions', 'classes'}:
+            return table
+    except (OSError, ValueError):
+        pass
+    table = read_spec(*files)
+    try:
+        os.makedirs(directory, exist_ok=True)
+        temp = f"{path}.{os.getpid()}"
+        with open(temp, 'w') as f:
+            json.dump(table, f)
+        os.replace(temp, path)
+    except OSError:
+        pass
+    return table
 
 def load_base():
     dirname = os.path.dirname(__file__)
-    parse_spec(os.path.join(dirname, 'spec/lichat.sexpr'),
-               os.path.join(dirname, 'spec/shirakumo.sexpr'))
+    load_spec(read_cached_spec(os.path.join(dirname, 'spec/lichat.sexpr'),
+                               os.path.join(dirname, 'spec/shirakumo.sexpr')))
+
+def __getattr__(name):
+    symbol = lazy_names.get(name)
+    if symbol is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return find_class(symbol)
+
+def __dir__():
+    return sorted(set(globals()) | set(lazy_names))
 
 load_base()
+
+# Include the classes that are only created on first access, so that a
+# star import defines them through __getattr__.
+__all__ = sorted(name for name in set(globals()) | set(lazy_names) if not name.startswith('_'))
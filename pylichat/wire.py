@@ -1,33 +1,18 @@
-from functools import singledispatch
-from .symbol import intern
+from .symbol import Symbol, intern
+import codecs
 import re
 
-@singledispatch
-def to_string(thing):
-    raise ValueError("Don't know what to do with {0}.".format(thing))
-
-def strchar(x):
-    if x == '"': return '\\"'
-    elif x == '\\': return '\\\\'
-    elif x == '\0': return ''
-    else: return x
+escape_rx = re.compile(r'["\\\0]')
+escape_table = str.maketrans({'"': '\\"', '\\': '\\\\', '\0': None})
 
-@to_string.register
-def _(thing: str):
-    return '"'+''.join([strchar(x) for x in thing])+'"'
-
-@to_string.register
-def _(thing: list):
-    return '('+' '.join([to_string(x) for x in thing])+')'
-
-@to_string.register
-def _(thing: int):
-    return format(thing)
+def escape_string(thing):
+    if escape_rx.search(thing) is None:
+        return thing
+    return thing.translate(escape_table)
 
 float_rx = re.compile(r"^(\d+)(?:.(\d+))?(?:e([+-]?\d+))?$", re.I)
 
-@to_string.register
-def _(thing: float):
+def float_to_string(thing):
     s = repr(thing)
     # Render exponents as digits instead; lichat spec does not allow for exponents.
     match = float_rx.match(s)
@@ -35,6 +20,7 @@ def _(thing: float):
         left, right, exp = match.groups()
         if exp is None:
             return s
+        right = right or ''
         exp = int(exp)
 
         while exp > 0:
@@ -54,29 +40,87 @@ def _(thing: float):
 
     raise ValueError(f"Can't send this float {s!r}")
 
-@to_string.register
-def _(thing: tuple):
-    if thing[0] == 'keyword':
-        return ':'+thing[1]
-    elif thing[0] == 'lichat':
-        return thing[1]
+def symbol_to_string(thing):
+    if type(thing) is Symbol:
+        package = thing.package
+        name = thing.name
     else:
-        return thing[0]+':'+thing[1]
-
-@to_string.register
-def _(thing: bool):
-    if thing:
-        return 'T'
+        (package, name) = thing
+    if package == 'keyword':
+        return ':'+name
+    elif package == 'lichat':
+        return name
     else:
-        return 'NIL'
+        return package+':'+name
 
-@to_string.register
-def _(thing: type(None)):
-    return 'NIL'
+def coerce(thing):
+    # Map subclasses of the supported types back onto the base types.
+    if isinstance(thing, bool): return bool(thing)
+    elif isinstance(thing, int): return int(thing)
+    elif isinstance(thing, float): return float(thing)
+    elif isinstance(thing, str): return str(thing)
+    elif isinstance(thing, list): return list(thing)
+    elif isinstance(thing, tuple): return tuple(thing)
+    raise ValueError("Don't know what to do with {0}.".format(thing))
+
+def write_bytes(thing, buffer):
+    """Serialise the thing as UTF-8 and append it to the given bytearray.
+
+    Nested lists are walked iteratively. Returns the buffer.
+    """
+    stack = []
+    first = True
+    while True:
+        kind = type(thing)
+        if kind is str:
+            buffer += b'"'
+            buffer += escape_string(thing).encode('utf-8')
+            buffer += b'"'
+        elif kind is list:
+            buffer += b'('
+            stack.append(iter(thing))
+            first = True
+        elif kind is Symbol or kind is tuple:
+            buffer += symbol_to_string(thing).encode('utf-8')
+        elif kind is int:
+            buffer += integer_to_string(thing).encode('ascii')
+        elif thing is None or thing is False:
+            buffer += b'NIL'
+        elif thing is True:
+            buffer += b'T'
+        elif kind is float:
+            buffer += float_to_string(thing).encode('ascii')
+        else:
+            thing = coerce(thing)
+            continue
+
+        while stack:
+            item = next(stack[-1], stack)
+            if item is stack:
+                buffer += b')'
+                stack.pop()
+                first = False
+            else:
+                if first:
+                    first = False
+                else:
+                    buffer += b' '
+                thing = item
+                break
+        else:
+            return buffer
+
+def to_string(thing):
+    return write_bytes(thing, bytearray()).decode('utf-8')
+
+whitespace_rx = re.compile(r"[\t\n\v\f\r ]*")
+string_rx = re.compile(r'[^"\\\0]*')
+token_rx = re.compile(r'[^: ".()\\]*')
+number_rx = re.compile(r"([0-9]*)(?:\.([0-9]*))?")
 
 def consume_whitespace(string, i, end):
-    while i<end and string[i] in '\u0009\u000A\u000B\u000C\u000D\u0020':
-        i = i+1
+    if i<end and string[i] in '\u0009\u000A\u000B\u000C\u000D\u0020':
+        return whitespace_rx.match(string, i, end).end()
     return i
 
 def read_list(string, i, end):
@@ -84,7 +128,7 @@ def read_list(string, i, end):
         i = i+1
         items = []
         while i<end and string[i] != ')' and string[i] != '\0':
-            (item, ni) = from_string(string, i)
+            (item, ni) = from_string(string, i, end)
             items.append(item)
             i = consume_whitespace(string, ni, end)
         if i<end and string[i] == ')':
@@ -94,41 +138,46 @@ def read_list(string, i, end):
 def read_string(string, i, end):
     if i<end and string[i] == '"':
         i = i+1
-        result = ''
-        while i<end and string[i] != '"' and string[i] != '\0':
-            if string[i] == '\\':
-                i = i+1
-            result = result+string[i]
-            i = i+1
+        j = string_rx.match(string, i, end).end()
+        if j<end and string[j] == '\\':
+            # Only strings with escapes need to be assembled from parts.
+            parts = []
+            while j<end and string[j] == '\\':
+                parts.append(string[i:j])
+                parts.append(string[j+1])
+                i = j+2
+                j = i
+                if i<end:
+                    j = string_rx.match(string, i, end).end()
+            parts.append(string[i:j])
+            result = ''.join(parts)
+        else:
+            result = string[i:j]
+        i = j
         if i<end and string[i] == '"':
             i = i+1
         return (result, i)
 
-def read_number_part(string, i, end):
-    decimal = 0
-    while i<end and string[i] in '0123456789':
-        decimal = decimal*10 + (ord(string[i])-48)
-        i = i+1
-    return (decimal, i)
-
 def read_number(string, i, end):
     if i<end and string[i] in '0123456789.':
-        (decimal, i) = read_number_part(string, i, end)
-        if i<end and string[i] == '.':
-            i = i+1
-            (fract, ni) = read_number_part(string, i, end)
-            num = decimal + float(fract) / (10.0 ** (ni-i))
-            return (num, ni)
-        return (decimal, i)
+        match = number_rx.match(string, i, end)
+        (decimal, fract) = match.groups()
+        return (make_number(decimal, fract), match.end())
 
 def read_token(string, i, end):
-    token = ''
-    while i<end and string[i] not in ': ".()':
-        if string[i] == '\\':
-            i = i+1
-        token = token+string[i]
-        i = i+1
-    return (token, i)
+    j = token_rx.match(string, i, end).end() if i<end else i
+    if j<end and string[j] == '\\':
+        parts = []
+        while j<end and string[j] == '\\':
+            parts.append(string[i:j])
+            parts.append(string[j+1])
+            i = j+2
+            j = i
+            if i<end:
+                j = token_rx.match(string, i, end).end()
+        parts.append(string[i:j])
+        return (''.join(parts), j)
+    return (string[i:j], j)
 
 def read_symbol(string, i, end):
     name = ''
@@ -150,7 +199,282 @@ def read_symbol(string, i, end):
 def from_string(string, i=0, end=-1):
     if end < 0: end = len(string)
     i = consume_whitespace(string, i, end)
-    return (read_list(string, i, end)
-            or read_string(string, i, end)
-            or read_number(string, i, end)
-            or read_symbol(string, i, end))
+    if i<end:
+        # Dispatch on the first character instead of trying every reader.
+        char = string[i]
+        if char == '(':
+            return read_list(string, i, end)
+        elif char == '"':
+            return read_string(string, i, end)
+        elif char in '0123456789.':
+            return read_number(string, i, end)
+    return read_symbol(string, i, end)
+
+stream_token_rx = re.compile(r'[^: ".()\\\0]*')
+digits_rx = re.compile(r"[0-9]*")
+
+# Python refuses to convert more than a configurable number of digits
+# at once, no fewer than 640, so longer integers are done in pieces.
+digit_chunk = 600
+digit_chunk_base = 10**digit_chunk
+
+def parse_integer(digits):
+    try:
+        return int(digits)
+    except ValueError:
+        value = 0
+        for i in range(0, len(digits), digit_chunk):
+            part = digits[i:i+digit_chunk]
+            value = value * 10**len(part) + int(part)
+        return value
+
+def integer_to_string(thing):
+    try:
+        return format(thing)
+    except ValueError:
+        (sign, thing) = ('-', -thing) if thing < 0 else ('', thing)
+        parts = []
+        while digit_chunk_base <= thing:
+            (thing, part) = divmod(thing, digit_chunk_base)
+            parts.append(format(part, f"0{digit_chunk}d"))
+        parts.append(format(thing))
+        parts.reverse()
+        return sign + ''.join(parts)
+
+def make_number(decimal, fract):
+    decimal = parse_integer(decimal) if decimal else 0
+    if fract is None:
+        return decimal
+    elif fract:
+        # Digits past this do not change the float anyway.
+        fract = fract[:300]
+        return decimal + float(int(fract)) / (10.0 ** len(fract))
+    else:
+        return decimal + 0.0
+
+class Parser:
+    """Incremental reader for a stream of NUL-terminated frames.
+
+    Bytes can be fed in as they arrive, split at arbitrary points,
+    including in the middle of a UTF-8 sequence. The parser keeps
+    its state between calls and returns every value that was
+    completed by the data fed in so far. Only the first value of
+    each frame is read, the rest of the frame is skipped, and
+    empty frames produce no value.
+
+    If sink is set, it is called with the partially read top-level
+    list whenever a string inside it begins. If it returns an object
+    rather than None, the string's text is passed to that object's
+    write method as it arrives instead of being collected, and the
+    value of its close method takes the string's place.
+    """
+    __slots__ = ('decoder', 'state', 'stack', 'parts', 'fraction', 'package', 'escape', 'values', 'position', 'sink', 'stream')
+
+    START = 0
+    AFTER_OPEN = 1
+    AFTER_ITEM = 2
+    ITEM = 3
+    STRING = 4
+    NUMBER = 5
+    PACKAGE = 6
+    NAME = 7
+    SKIP = 8
+
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.values = []
+        self.position = 0
+        self.sink = None
+        self.reset()
+
+    def reset(self):
+        """Discard any partially read frame."""
+        self.decoder.reset()
+        self.state = Parser.START
+        self.stack = []
+        self.parts = []
+        self.fraction = None
+        self.package = None
+        self.escape = False
+        self.stream = None
+
+    def feed(self, data):
+        """Feed received bytes and return the list of completed values."""
+        return self.parse(self.decoder.decode(data))
+
+    def finish(self):
+        """Signal the end of input, completing any value still being read."""
+        values = self.values = []
+        text = self.decoder.decode(b'', True)
+        if text:
+            values = self.parse(text)
+        self.terminate(self.position)
+        return values
+
+    def complete(self, value, i):
+        if self.stack:
+            self.stack[-1].append(value)
+            self.state = Parser.AFTER_ITEM
+        else:
+            self.values.append(value)
+            self.position = i
+            self.state = Parser.SKIP
+
+    def terminate(self, i):
+        state = self.state
+        if state == Parser.STRING:
+            self.complete(self.end_string(), i)
+        elif state == Parser.NUMBER:
+            self.complete(make_number(''.join(self.parts), self.fraction), i)
+        elif state == Parser.PACKAGE:
+            self.complete(intern(''.join(self.parts)), i)
+        elif state == Parser.NAME:
+            self.complete(intern(''.join(self.parts), self.package), i)
+        elif state == Parser.ITEM:
+            self.complete(intern(''), i)
+        while self.stack:
+            self.complete(self.stack.pop(), i)
+        self.state = Parser.START
+        self.escape = False
+
+    def end_string(self):
+        value = ''.join(self.parts)
+        stream = self.stream
+        if stream is not None:
+            self.stream = None
+            stream.write(value)
+            value = stream.close()
+        return value
+
+    def begin(self, string, i):
+        char = string[i]
+        self.parts = []
+        if char == '(':
+            self.stack.append([])
+            self.state = Parser.AFTER_OPEN
+            return i+1
+        elif char == '"':
+            self.state = Parser.STRING
+            if self.sink is not None and len(self.stack) == 1:
+                self.stream = self.sink(self.stack[0])
+            return i+1
+        elif char in '0123456789.':
+            self.fraction = None
+            self.state = Parser.NUMBER
+        else:
+            self.package = None
+            self.state = Parser.PACKAGE
+        return i
+
+    def parse(self, string, i=0, end=-1, count=0):
+        """Parse text that was already decoded and return the completed values.
+
+        If count is given, stop after that many values were completed.
+        """
+        if end < 0: end = len(string)
+        values = self.values = []
+        while i<end and not (count and count <= len(values)):
+            state = self.state
+            if state == Parser.SKIP:
+                j = string.find('\0', i, end)
+                if j < 0:
+                    i = end
+                else:
+                    self.state = Parser.START
+                    i = j+1
+            elif state == Parser.START or state == Parser.ITEM or state == Parser.AFTER_ITEM:
+                i = consume_whitespace(string, i, end)
+                if end <= i:
+                    break
+                char = string[i]
+                if state == Parser.START and char == '\0':
+                    i = i+1
+                elif state == Parser.AFTER_ITEM and char == ')':
+                    self.complete(self.stack.pop(), i+1)
+                    i = i+1
+                elif state == Parser.AFTER_ITEM and char == '\0':
+                    self.terminate(i)
+                    i = i+1
+                else:
+                    i = self.begin(string, i)
+            elif state == Parser.AFTER_OPEN:
+                char = string[i]
+                if char == ')':
+                    self.complete(self.stack.pop(), i+1)
+                    i = i+1
+                elif char == '\0':
+                    self.terminate(i)
+                    i = i+1
+                else:
+                    self.state = Parser.ITEM
+            elif state == Parser.STRING:
+                if self.escape:
+                    self.escape = False
+                    if string[i] != '\0':
+                        self.parts.append(string[i])
+                        i = i+1
+                    continue
+                j = string_rx.match(string, i, end).end()
+                if i < j:
+                    self.parts.append(string[i:j])
+                    i = j
+                    if self.stream is not None:
+                        self.stream.write(''.join(self.parts))
+                        self.parts = []
+                if i<end:
+                    char = string[i]
+                    if char == '\\':
+                        self.escape = True
+                        i = i+1
+                    elif char == '"':
+                        self.complete(self.end_string(), i+1)
+                        i = i+1
+                    else:
+                        self.terminate(i)
+                        i = i+1
+            elif state == Parser.NUMBER:
+                j = digits_rx.match(string, i, end).end()
+                if self.fraction is None:
+                    self.parts.append(string[i:j])
+                else:
+                    self.fraction = self.fraction+string[i:j]
+                i = j
+                if i<end:
+                    if self.fraction is None and string[i] == '.':
+                        self.fraction = ''
+                        i = i+1
+                    else:
+                        self.complete(make_number(''.join(self.parts), self.fraction), i)
+            else:
+                if self.escape:
+                    self.escape = False
+                    if string[i] != '\0':
+                        self.parts.append(string[i])
+                        i = i+1
+                    continue
+                j = stream_token_rx.match(string, i, end).end()
+                if i < j:
+                    self.parts.append(string[i:j])
+                    i = j
+                if i<end:
+                    char = string[i]
+                    token = ''.join(self.parts)
+                    if char == '\\':
+                        self.escape = True
+                        i = i+1
+                    elif state == Parser.PACKAGE and char == ':':
+                        if token == '':
+                            token = 'keyword'
+                        # FIXME: Temporary workaround!
+                        if token == 'shirakumo':
+                            token = 'lichat'
+                        self.package = token
+                        self.parts = []
+                        self.state = Parser.NAME
+                        i = i+1
+                    elif state == Parser.PACKAGE:
+                        self.complete(intern(token), i)
+                    else:
+                        self.complete(intern(token, self.package), i)
+        self.position = i
+        return values
@@ -0,0 +1,84 @@
+import collections
+import unittest
+
+from pylichat import update, wire
+from pylichat.client import Client, RequestFailed
+
+class SearchServer(Client):
+    """A client whose updates are answered by a fake server holding total messages.
+
+    Each page of at most page_size results is sent back in replies
+    of at most split results each, all with the ID of the search.
+    """
+    __slots__ = ('total', 'page_size', 'split', 'requests', 'offsets', 'fail')
+
+    def __init__(self, total, page_size=50, split=None, fail=False):
+        super().__init__('tester')
+        self.socket = object()
+        self.total = total
+        self.page_size = page_size
+        self.split = split or page_size
+        self.requests = collections.deque()
+        self.offsets = []
+        self.fail = fail
+
+    def transmit(self, instance, callback=None):
+        if callback is not None:
+            self.callbacks[instance.id] = (callback, instance)
+        self.requests.append(instance)
+        self.offsets.append(instance.offset)
+
+    def wait(self, future, timeout=None):
+        while not future.done():
+            self.answer(self.requests.popleft())
+        return future.result()
+
+    def answer(self, request):
+        if self.fail:
+            self.handle(update.make_instance(update.NotInChannel, **{
+                'from': 'server', 'id': 1, 'clock': 0, 'update-id': request.id}))
+            return
+        offset = request.offset
+        results = [self.message(i) for i in range(offset, min(self.total, offset + self.page_size))]
+        for start in range(0, max(1, len(results)), self.split):
+            self.handle(update.make_instance(update.Search, **{
+                'from': 'tester', 'id': request.id, 'clock': 0, 'channel': request.channel,
+                'offset': offset, 'results': results[start:start + self.split]}))
+
+    def message(self, i):
+        return wire.from_string(f'(message :id {i} :from "someone" :clock {i} :channel "test" :text "{i}")')[0]
+
+class TestSearch(unittest.TestCase):
+    def search(self, client, prefetch=2):
+        return [result.id for result in client.search('test', [], prefetch=prefetch)]
+
+    def test_pages(self):
+        for total in (0, 49, 50, 51, 301):
+            for page_size in (50, 64, 120):
+                client = SearchServer(total, page_size)
+                self.assertEqual(self.search(client), list(range(total)), (total, page_size))
+
+    def test_split_pages(self):
+        for total in (0, 30, 80, 100, 333):
+            for (page_size, split) in ((50, 25), (50, 1), (120, 50), (64, 30)):
+                for prefetch in (1, 2, 4):
+                    client = SearchServer(total, page_size, split)
+                    self.assertEqual(self.search(client, prefetch), list(range(total)),
+                                     (total, page_size, split, prefetch))
+                    self.assertEqual(client.callbacks, {})
+
+    def test_close_early(self):
+        client = SearchServer(1000)
+        results = client.search('test', [], prefetch=3)
+        next(results)
+        results.close()
+        self.assertEqual(client.callbacks, {})
+
+    def test_failure(self):
+        client = SearchServer(100, fail=True)
+        with self.assertRaises(RequestFailed):
+            self.search(client)
+        self.assertEqual(client.callbacks, {})
+
+if __name__ == '__main__':
+    unittest.main()